@@ -20,12 +20,11 @@ setup(
     },
     install_requires=[
         "numpy",
-        "scikit-image",
+        "tifffile",
         "pyyaml",
         "tqdm",
         "click",
-        "motmot.FlyMovieFormat",
-        "ffmpy" # TODO: replace with ffmpeg-python
+        "motmot.FlyMovieFormat"
     ]
 
 )
\ No newline at end of file
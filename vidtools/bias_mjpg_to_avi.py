@@ -16,73 +16,97 @@ in a given directory.
 
 import argparse
 import glob
+import mmap
 import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from os.path import join, split, splitext
 
 import cv2
 import numpy as np
 
+# Let OpenCV's decoding, resizing, and encoding use every core. Worker processes 
+# split the cores between them instead; see main():
+cv2.setUseOptimized(True)
+cv2.setNumThreads(os.cpu_count())
+if not cv2.useOptimized():
+    warnings.warn("OpenCV's optimized code paths are unavailable, so converting will be slow.")
+
+
+INDEX_DTYPE = np.dtype([
+    ('frame', 'i8'), 
+    ('timestamp', 'f8'), 
+    ('start_pos', 'i8'), 
+    ('end_pos', 'i8'),
+    ])
+
 
 def read_indexfile(indexfile):
-    with open(indexfile,'r') as f:
-        raw_line_list = f.readlines()
-    index_list = []
-    for raw_line in raw_line_list:
-        tmp = raw_line.split(' ')
-        item = {
-                'frame': int(tmp[0]), 
-                'timestamp': float(tmp[1]), 
-                'start_pos': int(tmp[2]), 
-                'end_pos': int(tmp[3]),
-                }
-        index_list.append(item)
+    """ Parse the whole index file in one go, into a structured array with one row per frame"""
+    index_list = np.loadtxt(indexfile, dtype=INDEX_DTYPE, ndmin=1)
     return index_list
 
 
 def get_framerate(index_list, num_avg=10):
-    """ Get framerate .. average over first 10 frames"""
-    f_list= []
-    num_avg = min(num_avg,len(index_list))
-    for i in range(1,num_avg):
-        t1 = index_list[i]['timestamp']
-        t0 = index_list[i-1]['timestamp']
-        dt = t1 - t0
-        try:
-            f = 1/dt
-            f_list.append(f)
-        except:
-            pass
-    f_array = np.array(f_list)
-    f_mean = f_array.mean()
+    """ Get framerate .. average over first 10 frames, skipping repeated timestamps"""
+    dt_array = np.diff(index_list['timestamp'][:num_avg])
+    f_mean = (1/dt_array[dt_array > 0]).mean()
     return f_mean
 
 
-def convert_bias_mjpg(bias_indexfile, bias_moviefile, outfile, scale=1.0):
+def convert_bias_mjpg(bias_indexfile, bias_moviefile, outfile, scale=1.0, do_show=False):
     index_list = read_indexfile(bias_indexfile)
     fourcc = cv2.VideoWriter_fourcc(*'XVID')
     framerate = get_framerate(index_list) # can hardcode here if greater than 65 Hz
     vid = None
     print(bias_moviefile)
     # import ipdb; ipdb.set_trace()
-    with open(bias_moviefile,'rb') as f:
+    # Map the image stack into memory, so that frames are sliced from the page cache, rather than seeked and read:
+    with open(bias_moviefile,'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
         for i, index_item in enumerate(index_list):
             # Extract frame from file
             print('frame: {}, timestamp: {:1.2f}'.format(index_item['frame'],index_item['timestamp'])) 
-            f.seek(index_item['start_pos'])
-            data = f.read(index_item['end_pos'] - index_item['start_pos']+1)
-            img = cv2.imdecode(np.fromstring(data,dtype=np.uint8),-1)
+            data = mm[index_item['start_pos']:index_item['end_pos']+1]
+            img = cv2.imdecode(np.frombuffer(data,dtype=np.uint8),cv2.IMREAD_COLOR)
             (n,m,k) = img.shape
             n_scaled = int(scale*n)
             m_scaled = int(scale*m)
             img_scaled = cv2.resize(img,(m_scaled,n_scaled))
             if vid is None:
                 vid = cv2.VideoWriter(outfile, fourcc, framerate, (m_scaled,n_scaled))
-            cv2.imshow('frame',img_scaled)
             vid.write(img_scaled)
-            key = cv2.waitKey(1) & 0xff
-            if key == ord('q'):
-                break
-            
+            if do_show:
+                cv2.imshow('frame',img_scaled)
+                key = cv2.waitKey(1) & 0xff
+                if key == ord('q'):
+                    break
+    if vid is not None:
+        vid.release()
+    if do_show:
+        cv2.destroyAllWindows()
+
+
+def convert_folder(folder, scale=1.0, do_show=False):
+    """ Convert a folder's .mjpg image stack .. only show it outside of worker processes"""
+
+    indexfile = glob.glob(join(folder, "index.txt"))
+    moviefile = glob.glob(join(folder, "*.mjpg"))
+
+    assert indexfile,\
+        f"The folder, {folder}, has no index.txt files."
+    assert len(indexfile)==1,\
+        f"The folder, {folder}, must have exactly 1 index.txt file."
+    assert moviefile,\
+        f"The folder, {folder}, has no .mjpg image stacks."
+    assert len(moviefile)==1,\
+        f"The folder, {folder}, must have exactly 1 .mjpg file"
+
+    outfile_base, _ = splitext(moviefile[0])
+    outfile = f"{outfile_base}.avi"
+
+    convert_bias_mjpg(indexfile[0], moviefile[0], outfile, scale, do_show)
+
 
 def main():
 
@@ -97,32 +121,32 @@ def main():
     parser.add_argument("scale", type=float, nargs="?", default=1.0,
         help="The scale of the video to be converted, relative to the raw input.\
             The default value is 1.0.")
+    parser.add_argument("-s", "--show", action="store_true",
+        help="Show each frame as it is converted. Folders are then converted\
+            one at a time, rather than in parallel.")
     args = parser.parse_args()
 
     root = args.root
     nesting = args.nesting
     scale = args.scale
+    show = args.show
 
     # TODO: use Path from pathlib instead of glob and nesting
     folders = sorted(glob.glob(join(root, nesting * "*/")))
-    for folder in folders:
-
-        indexfile = glob.glob(join(folder, "index.txt"))
-        moviefile = glob.glob(join(folder, "*.mjpg"))
-
-        assert indexfile,\
-            f"The folder, {folder}, has no index.txt files."
-        assert len(indexfile)==1,\
-            f"The folder, {folder}, must have exactly 1 index.txt file."
-        assert moviefile,\
-            f"The folder, {folder}, has no .mjpg image stacks."
-        assert len(moviefile)==1,\
-            f"The folder, {folder}, must have exactly 1 .mjpg file"
-
-        outfile_base, _ = splitext(moviefile[0])
-        outfile = f"{outfile_base}.avi"
 
-        convert_bias_mjpg(indexfile[0], moviefile[0], outfile, scale)
+    # GUI calls don't belong in worker processes:
+    if show:
+        for folder in folders:
+            convert_folder(folder, scale, do_show=True)
+
+    # Each folder is an independent job, so convert them in parallel:
+    else:
+        # Split the cores between the workers, rather than giving each worker OpenCV 
+        # threads for every core, which would oversubscribe the CPU:
+        n_workers = max(1, min(len(folders), os.cpu_count()))
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=cv2.setNumThreads, 
+                                 initargs=(max(1, os.cpu_count() // n_workers),)) as executor:
+            list(executor.map(partial(convert_folder, scale=scale), folders))
         
 
 if __name__ == '__main__':
@@ -3,7 +3,7 @@ Use Hough Circle Transform to find a single mean circle from a dir of videos.
 Typical use case is for identifying the boundaries of a circular arena. 
 """
 
-from os.path import expanduser, splitext, basename
+from os.path import expanduser, splitext, basename, abspath
 from pathlib import Path
 import pickle
 from pprint import pprint
@@ -11,7 +11,7 @@ from pprint import pprint
 import numpy as np
 import cv2
 
-from vidtools.common import ask_yes_no
+from vidtools.common import ask_yes_no, find_files
 
 
 def find_circle(vid, dp=2, param1=80, param2=200, minDist=140, 
@@ -64,7 +64,9 @@ def find_circle(vid, dp=2, param1=80, param2=200, minDist=140,
     if len(frames) == 0:
         num_chosen = 5
         frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        samples = np.random.choice(frame_count, num_chosen)
+        # Without replacement, so no frame is searched twice; seeded, so reruns find the same mean circle:
+        rng = np.random.default_rng(0)
+        samples = rng.choice(frame_count, size=min(num_chosen, frame_count), replace=False)
     
     # Option 2: Draw specified frames from video:
     else:
@@ -167,7 +169,7 @@ def get_mean_circle_info(circle_info):
             "r (pxls)":np.mean(rs)}
 
 
-def mask_and_crop(vid, mean_circle_info, framerate):
+def mask_and_crop(vid, mean_circle_info, framerate, do_show=False):
 
     """
     Mask a video with a circle, and then crop the video around the circle. 
@@ -177,6 +179,8 @@ def mask_and_crop(vid, mean_circle_info, framerate):
     vid (str): Path to the input video
     mean_circle_info (dict): The output of `get_mean_circle_info()`.
     framerate: The video framerate.
+    do_show (bool): If True, will display the masked and cropped video while it 
+        is written, which slows the writing. Default is False. 
 
     Returns:
     --------
@@ -198,14 +202,24 @@ def mask_and_crop(vid, mean_circle_info, framerate):
     spacing = 5
     target_edge = 2 * (r + spacing)
 
-    # Define the codec and create VideoWriter object
+    # Define the codec and create VideoWriter object; the frames are grayscale, 
+    # so write them as single channels, rather than re-expanding them to BGR:
     fourcc = cv2.VideoWriter_fourcc(*"mp4v") 
     out = cv2.VideoWriter(filename=output_vid, 
                             apiPreference=0, 
                             fourcc=fourcc, 
                             fps=int(framerate), 
                             frameSize=(int(target_edge), int(target_edge)), 
-                            params=None)
+                            isColor=False)
+
+    # Crop (centred about circle centre):
+    crop = (slice(y-r-spacing, y+r+spacing), slice(x-r-spacing, x+r+spacing))
+
+    # The circle is the same in every frame, so draw its mask once, and keep 
+    # just the cropped part, as the rest of each frame is discarded anyway:
+    mask = np.zeros((height, width), dtype="uint8")
+    cv2.circle(mask, (x,y), r, 255, -1)
+    roi_mask = mask[crop]
 
     while cap.isOpened():
 
@@ -213,36 +227,30 @@ def mask_and_crop(vid, mean_circle_info, framerate):
         
         if ret:
 
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-
-            # Mask:
-            mask = np.zeros((height, width), dtype="uint8")
-            cv2.circle(mask, (x,y), r, 255, -1)
-            masked = cv2.bitwise_and(gray, gray, mask=mask)
-
-            # Crop (centred about circle centre): 
-            roi = masked[y-r-spacing : y+r+spacing, x-r-spacing : x+r+spacing]
-
-            # In OpenCV, images saved to video file must be three channels:
-            re_bgr = cv2.cvtColor(roi, cv2.COLOR_GRAY2BGR)
+            # Crop, then convert and mask just the crop:
+            roi = cv2.cvtColor(frame[crop], cv2.COLOR_BGR2GRAY)
+            roi = cv2.bitwise_and(roi, roi, mask=roi_mask)
 
             # # Inspect the location of the new circle centre:
             # x_after_crop = int(roi.shape[1]/2)
             # y_after_crop = int(roi.shape[0]/2)
-            # test = cv2.circle(roi, (x_after_crop, y_after_crop), 5, (0,0,255), -1)
-            # re_bgr = cv2.cvtColor(test, cv2.COLOR_GRAY2BGR)
+            # roi = cv2.circle(roi, (x_after_crop, y_after_crop), 5, 255, -1)
+
+            out.write(roi)
 
-            out.write(re_bgr)
-            cv2.imshow("masked", re_bgr)
+            if do_show:
 
-            if cv2.waitKey(1) & 0xFF == ord("q"):
-                break
+                cv2.imshow("masked", roi)
+                if cv2.waitKey(1) & 0xFF == ord("q"):
+                    break
 
         else: 
             break
 
     cap.release()
     out.release()
+    if do_show:
+        cv2.destroyAllWindows()
 
     x_after_crop = int(roi.shape[1]/2)
     y_after_crop = int(roi.shape[0]/2)
@@ -256,7 +264,7 @@ def mask_and_crop(vid, mean_circle_info, framerate):
 def main(config):
 
     root = expanduser(config["circular_mask_crop"]["root"])
-    vid_ending = '*' + config["circular_mask_crop"]["vid_ending"]
+    vid_ending = config["circular_mask_crop"]["vid_ending"]
     framerate = int(config["circular_mask_crop"]["framerate"])
     dp = int(config["circular_mask_crop"]["dp"])
     param1 = int(config["circular_mask_crop"]["param1"])
@@ -266,12 +274,12 @@ def main(config):
     maxRadius = int(config["circular_mask_crop"]["maxRadius"])
     frames = config["circular_mask_crop"]["frames"]
     do_ask = config["circular_mask_crop"]["do_ask"]
+    do_show = config["circular_mask_crop"]["do_show"]
     
-    vids = [str(path.absolute()) for path in Path(root).rglob(vid_ending) 
-            if ".mp4" in str(path.absolute())]
+    vids = [vid for vid in find_files(abspath(root), vid_ending) if ".mp4" in vid]
 
     if len(vids) == 0:
-        raise ValueError(f"No .mp4 videos ending with '{vid_ending}' were found.")
+        raise ValueError(f"No .mp4 videos ending with '*{vid_ending}' were found.")
 
     for vid in vids:
         
@@ -295,9 +303,10 @@ def main(config):
             results = get_mean_circle_info(all_circles)
 
             # Mask and crop video, then save:
-            results_after_cropping = mask_and_crop(vid, results, framerate)
+            results_after_cropping = mask_and_crop(vid, results, framerate, do_show)
 
             print("mean circle:")
             pprint(results)
-            pickle.dump(results_after_cropping, open(output_pkl, "wb"))
+            with open(output_pkl, "wb") as f:
+                pickle.dump(results_after_cropping, f, protocol=pickle.HIGHEST_PROTOCOL)
             print(f"The mean circle has been saved to {output_pkl} .")
\ No newline at end of file
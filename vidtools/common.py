@@ -2,6 +2,17 @@
 Utility functions for helping with video analyses. 
 """
 
+import os
+import subprocess
+from queue import Queue, Empty
+from threading import Thread, Event, BoundedSemaphore
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from itertools import chain
+
+import numpy as np
+import cv2
+
 def ask_yes_no(question, default="yes"):
 
     """
@@ -54,10 +65,43 @@ def flatten_list(list_of_lists):
     A list.
     """
     
-    # Reach into each inner list and append into a new list: 
-    flat_list = [item for inner_list in list_of_lists for item in inner_list]
+    # Chain the inner lists together, in C, rather than item by item: 
+    return list(chain.from_iterable(list_of_lists))
+
 
-    return flat_list
+def find_files(root, ext):
+
+    """
+    Recursively find the files with a given ending under a folder, with 
+    `os.scandir()`, which, unlike `Path.rglob()`, gets each entry's type without 
+    an extra stat call, or a `Path` object per file. 
+
+    Parameters:
+    -----------
+    root (str): Path to the folder to search. 
+    ext (str): The ending of the file names, e.g. ".jpg" or "_undistorted.mp4". 
+
+    Returns:
+    --------
+    A generator of the files' paths, as strs. Like `Path.rglob()`, skips folders 
+    that can't be read, and doesn't descend into symlinked folders, which could 
+    loop forever. 
+    """
+
+    try:
+        entries = os.scandir(root)
+    except OSError as e:
+        print(f"Could not read '{root}': {e.strerror}. Skipping ...")
+        return
+
+    with entries:
+        for entry in entries:
+
+            if entry.is_dir(follow_symlinks=False):
+                yield from find_files(entry.path, ext)
+
+            elif entry.is_file() and entry.name.endswith(ext):
+                yield entry.path
 
 
 def parse_readme_for_docstrings(readme_path):
@@ -114,4 +158,402 @@ def docstring_parameter(*sub):
     def dec(obj):
         obj.__doc__ = obj.__doc__.format(*sub)
         return obj
-    return dec
\ No newline at end of file
+    return dec
+
+
+def iter_frames(vid, start=0):
+
+    """
+    Decode the frames of a video one at a time, so that they can be processed 
+    in memory, rather than round-tripped through image files on disk. 
+
+    Parameters:
+    -----------
+    vid (str): Path to a video. 
+    start (int): The index of the first frame to decode. Default is 0. 
+
+    Returns:
+    --------
+    A generator of (index, frame) tuples. 
+    """
+
+    cap = cv2.VideoCapture(vid)
+    if not cap.isOpened():
+        raise ValueError(f"'{vid}' could not be opened.")
+
+    try:
+        if start > 0:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+
+        i = start
+        while True:
+
+            ret, frame = cap.read()
+            if not ret:
+                break
+
+            yield i, frame
+            i += 1
+
+    finally:
+        cap.release()
+
+
+def iter_gray_frames(vid, frame_size):
+
+    """
+    Decode the frames of a video one at a time, as grayscale, by piping them out 
+    of an FFmpeg subprocess. FFmpeg keeps just the luma plane of the decoded frames, 
+    so, unlike `cv2.VideoCapture`, no 3-channel BGR frame is ever built, only to 
+    be converted back to grayscale. FFmpeg must be installed. 
+
+    Parameters:
+    -----------
+    vid (str): Path to a video. 
+    frame_size (tuple): The width then height of the video's frames. 
+
+    Returns:
+    --------
+    A generator of single-channel frames, as uint8 arrays. Raises a RuntimeError 
+    if FFmpeg fails to decode the video. 
+    """
+
+    width, height = frame_size
+    n_bytes = width * height
+
+    # E.g. `cv2.VideoCapture` reports a size of 0 x 0 for a video it can't open:
+    if n_bytes <= 0:
+        raise ValueError(f"'{vid}' has an invalid frame size of {width} x {height}.")
+
+    args = ["ffmpeg", "-nostdin", "-loglevel", "error", "-i", vid, 
+            "-f", "rawvideo", "-pix_fmt", "gray", "-"]
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE)
+
+    try:
+        while True:
+
+            # Read straight into the frame's own buffer, which the array then wraps. 
+            # A short read, including an empty one, means FFmpeg has stopped:
+            buf = bytearray(n_bytes)
+            n_read = proc.stdout.readinto(buf)
+            if n_read != n_bytes:
+                break
+
+            yield np.frombuffer(buf, dtype=np.uint8).reshape(height, width)
+
+        # Tell the end of the video apart from a failed decode:
+        returncode = proc.wait()
+        if returncode != 0:
+            raise RuntimeError(f"FFmpeg failed to decode '{vid}', with exit code {returncode}.")
+
+    finally:
+        proc.stdout.close()
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+
+
+def read_frames(cap, frames_q, stop, stride=1):
+
+    """
+    Decode frames from a video into a queue, until the video runs out of frames 
+    or until `stop` is set. Meant to be the target of a reader thread. 
+
+    Parameters:
+    -----------
+    cap: An opened `cv2.VideoCapture` object. 
+    frames_q (Queue): The queue into which decoded frames are put. A final 
+        `None` is put into the queue to mark the end of the frames. 
+    stop (Event): If set, stops reading frames. 
+    stride (int): Only every `stride`th frame is put into the queue. Default is 1. 
+    """
+
+    while not stop.is_set():
+
+        ret, frame = cap.read()
+        if not ret:
+            break
+
+        frames_q.put(frame)
+
+        # Advance past the frames in between with grab(), which skips retrieving them:
+        for _ in range(stride - 1):
+            if not cap.grab():
+                break
+
+    frames_q.put(None)
+
+
+def write_frames(out, frames_q, stop, errors):
+
+    """
+    Encode frames from a queue into a video, until a `None` is taken from 
+    the queue. Meant to be the target of a writer thread. 
+
+    Parameters:
+    -----------
+    out: An opened `cv2.VideoWriter` object.
+    frames_q (Queue): The queue from which frames are taken.
+    stop (Event): Is set if encoding fails, to stop the reader thread. 
+    errors (list): Any exception raised by encoding is appended to this list. 
+    """
+
+    while True:
+
+        frame = frames_q.get()
+        if frame is None:
+            break
+
+        if errors:
+            # Keep draining the queue, so that whoever puts frames into it can't 
+            # block on a full queue:
+            continue
+
+        try:
+            out.write(frame)
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+
+
+def start_frame_pipeline(cap, out, prefetch=16, stride=1):
+
+    """
+    Start a reader thread that decodes frames from `cap`, and a writer thread 
+    that encodes frames to `out`, so that decoding and encoding overlap with 
+    whatever processing happens on the main thread. GUI calls, like 
+    `cv2.imshow()`, should stay on the main thread. 
+
+    Parameters:
+    -----------
+    cap: An opened `cv2.VideoCapture` object. 
+    out: An opened `cv2.VideoWriter` object. 
+    prefetch (int): The maximum number of frames held in each queue. 
+        Default is 16. 
+    stride (int): Only every `stride`th frame of `cap` is decoded into the 
+        generator. Default is 1. 
+
+    Returns:
+    --------
+    A generator of decoded frames, the queue into which processed frames are 
+    put for encoding, and a function that stops both threads and waits for 
+    them to finish. If encoding fails, the generator stops early, and the 
+    function raises the encoding error. 
+    """
+
+    read_q = Queue(maxsize=prefetch)
+    write_q = Queue(maxsize=prefetch)
+    stop = Event()
+    errors = []
+
+    reader = Thread(target=read_frames, args=(cap, read_q, stop, stride), daemon=True)
+    writer = Thread(target=write_frames, args=(out, write_q, stop, errors), daemon=True)
+    reader.start()
+    writer.start()
+
+    def frames():
+
+        while True:
+
+            frame = read_q.get()
+            if frame is None:
+                break
+
+            yield frame
+
+    def finish():
+
+        # Stop the reader, and keep draining the read queue so that it 
+        # can't block on a full queue, in case the main thread quit early:
+        stop.set()
+        while reader.is_alive():
+            try:
+                read_q.get(timeout=0.1)
+            except Empty:
+                pass
+
+        write_q.put(None)
+        writer.join()
+
+        if errors:
+            raise errors[0]
+
+    return frames(), write_q, finish
+
+
+def bounded_map(executor, fn, iterable, max_pending, key=None):
+
+    """
+    Like `executor.map()`, but submits at most `max_pending` tasks ahead of the 
+    results that have been consumed, so that a long iterable, like the frames of 
+    a video, is never held in memory all at once. 
+
+    Parameters:
+    -----------
+    executor: A `concurrent.futures` executor. 
+    fn: The function to apply to each item. Must be picklable, if `executor` is 
+        a `ProcessPoolExecutor`. 
+    iterable: The items to apply `fn` to. 
+    max_pending (int): The maximum number of submitted, but unconsumed, tasks.
+    key: If given, `fn` is applied to `key(item)`, rather than to each item, e.g. 
+        to send a smaller version of each item to a process pool. Default is None. 
+
+    Returns:
+    --------
+    A generator of (item, result) tuples, in the same order as `iterable`. 
+    """
+
+    pending = deque()
+
+    for item in iterable:
+
+        arg = item if key is None else key(item)
+        pending.append((item, executor.submit(fn, arg)))
+
+        if len(pending) >= max_pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+
+    while pending:
+        item, future = pending.popleft()
+        yield item, future.result()
+
+
+def write_img(filename, img, params=()):
+
+    """
+    Save an image with `cv2.imwrite()`, but raise, rather than return False, if 
+    it can't be saved, so that a failed save on a worker thread surfaces through 
+    its future's `result()`. 
+
+    Parameters:
+    -----------
+    filename (str): Path to the output image. Its extension sets the format. 
+    img (ndarray): The image. 
+    params (sequence): `cv2.imwrite()`'s format-specific parameters. 
+
+    Returns:
+    --------
+    None. Raises an OSError if the image couldn't be saved. 
+    """
+
+    if img is None:
+        raise ValueError(f"No image to save to '{filename}'.")
+
+    if not cv2.imwrite(filename, img, params):
+        raise OSError(f"Could not save '{filename}'.")
+
+
+class BoundedThreadPoolExecutor(ThreadPoolExecutor):
+
+    """
+    A `ThreadPoolExecutor` whose `submit()` blocks once `max_pending` tasks are 
+    queued or running, so that a fast producer, like a video decoding loop that 
+    submits `cv2.imwrite()` calls, can't pile up frames in memory faster than 
+    the workers can save them. 
+
+    Parameters:
+    -----------
+    max_workers (int): The maximum number of worker threads. Default is the 
+        `ThreadPoolExecutor` default. 
+    max_pending (int): The maximum number of submitted, but unfinished, tasks. 
+        Default is twice the number of worker threads. 
+    """
+
+    def __init__(self, max_workers=None, max_pending=None):
+
+        super().__init__(max_workers=max_workers)
+        self.slots = BoundedSemaphore(max_pending or 2 * self._max_workers)
+
+    def submit(self, fn, *args, **kwargs):
+
+        self.slots.acquire()
+        future = super().submit(fn, *args, **kwargs)
+        future.add_done_callback(lambda _: self.slots.release())
+
+        return future
+
+
+class FFmpegWriter:
+
+    """
+    A drop-in replacement for `cv2.VideoWriter` that pipes raw frames into an 
+    FFmpeg subprocess, so that videos are encoded with H.264, rather than with 
+    OpenCV's slower, and larger, MPEG-4 Part 2 ('mp4v') encoder. FFmpeg must be 
+    installed. 
+
+    Parameters:
+    -----------
+    filename (str): Path to the output video. Is overwritten, if it exists. 
+    fps (int): Framerate of the output video. 
+    frame_size (tuple): The width then height of the frames to be written. 
+    codec (str): The FFmpeg encoder. E.g. "libx264", or "h264_nvenc" to encode on 
+        an NVIDIA GPU. Default is "libx264". 
+    crf (int): The constant rate factor (or, for NVENC, the constant quality), from 
+        0, the least compressed, to 51, the most compressed. Default is 18. 
+    preset (str or None): The encoder's speed preset, e.g. "veryfast" to trade file 
+        size for speed. If None, uses the encoder's default. Default is None. 
+    is_color (bool): If True, frames are 3-channel BGR. If False, frames are 
+        single-channel grayscale, which is a third of the bytes to pipe, and needs 
+        no re-expansion to BGR. Default is True. 
+
+    Raises a RuntimeError from `write()` or `release()` if FFmpeg fails. Can be 
+    used as a context manager, which calls `release()` on exit. 
+    """
+
+    def __init__(self, filename, fps, frame_size, codec="libx264", crf=18, preset=None, 
+                 is_color=True):
+
+        width, height = frame_size
+        quality = ["-cq", str(crf)] if "nvenc" in codec else ["-crf", str(crf)]
+        if preset is not None:
+            quality += ["-preset", preset]
+
+        args = ["ffmpeg", "-y", "-loglevel", "error",
+                "-f", "rawvideo", "-pix_fmt", "bgr24" if is_color else "gray", 
+                "-s", f"{width}x{height}", 
+                "-r", str(fps), "-i", "-",
+                "-c:v", codec, *quality, 
+                # yuv420p needs even dims, so pad odd dims by a pixel:
+                "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", "-pix_fmt", "yuv420p", 
+                filename]
+
+        self.filename = filename
+        self.proc = subprocess.Popen(args, stdin=subprocess.PIPE)
+
+    def write(self, frame):
+
+        # Cropped frames are views, which must be made contiguous before piping. 
+        # If FFmpeg already died, e.g. on a bad encoder, the pipe is broken:
+        try:
+            self.proc.stdin.write(np.ascontiguousarray(frame))
+        except BrokenPipeError as e:
+            raise RuntimeError(f"FFmpeg failed to encode '{self.filename}', "
+                               f"with exit code {self.proc.wait()}.") from e
+
+    def release(self):
+
+        # Closing stdin tells FFmpeg to finalize the file; if FFmpeg already died, 
+        # the pipe is broken, and its exit code says why:
+        try:
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+
+        returncode = self.proc.wait()
+        if returncode != 0:
+            raise RuntimeError(f"FFmpeg failed to encode '{self.filename}', "
+                               f"with exit code {returncode}.")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+
+        # Always reap FFmpeg, but don't hide an error raised in the `with` block 
+        # behind FFmpeg's own:
+        try:
+            self.release()
+        except RuntimeError:
+            if exc_info[0] is None:
+                raise
@@ -2,22 +2,39 @@
 
 """
 Convert raw .fmf videos to compressed and viewable .avi or .mp4 video files.
-The .fmf video is converted to an uncompressed directory of .tiff files, 
-before being compressed to the .avi or .mp4. Make sure the libx264 encoder is 
-enabled in your FFMPEG installation. 
+The frames of the .fmf video are streamed straight into FFMPEG. If the .tiffs 
+are to be kept, each frame is also saved to an uncompressed directory of .tiff 
+files in the same pass. Make sure the libx264 encoder is enabled in your FFMPEG 
+installation. 
 """
 
 import os
 import shutil
+import subprocess
 import glob
 import sys
 import argparse
 from os.path import join
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 
-import skimage.io 
+import numpy as np
+import cv2
+import tifffile
 import tqdm
 import motmot.FlyMovieFormat.FlyMovieFormat as FMF
-from ffmpy import FFmpeg
+
+
+# Resolve the FFmpeg executable once, rather than on every call:
+FFMPEG = shutil.which("ffmpeg") or "ffmpeg"
+
+# The number of frames streamed into FFmpeg's stdin per `writev` syscall:
+FRAMES_PER_WRITE = 16
+# The size of the buffer on FFmpeg's stdin, for frames that aren't memory-mapped:
+PIPE_BUFFER_SIZE = 1 << 20
+# The number of threads per .fmf that write kept .tiffs; the .fmfs are already
+# converted in parallel processes:
+TIFF_WRITERS = 2
 
 
 def mkdirs4tiffs (names):
@@ -33,180 +50,458 @@ def mkdirs4tiffs (names):
     to video path and executing `rm -r */` 
     '''
     
-    assert (names),\
-        "You've inputted an empty list. Please provide a populated list."
-    for name in names:
-        assert(".fmf" in name),\
-            f"The file {name} is not an .fmf video. Please provide an .fmf file."
-
     # Each directory will have the same name as the .fmf video:
-    folders = []
     for name in names:
-        folders.append(name.replace('.fmf',''))
-
-    # Make the directories:
-    for folder in folders:
-        # Check if the directory exists already:
-        isDir = os.path.isdir(folder)
-        if not isDir:
-            os.mkdir(os.path.join(folder))
-        else:
-            print("Directory already exists")
-            continue
+        os.makedirs(name[:-len(".fmf")], exist_ok=True)
 
 
-def get_framerate_duration (names):
+def probe (name):
 
     '''
-    Get the frame rate and length of video (secs) from a list of .fmf videos.
+    Opens an .fmf video and computes its frame count and frame rate. Reads only the\
+    first and last time stamps, rather than seeking through every frame's. 
     
     Parameters:
-    names (list): a list of the .fmf files to be converted
+    name (str): The .fmf file to be probed.
     
     Returns:
-    Empty directories for each .fmf video. Can undo in terminal by navigating \
-    to `vid_path` and executing `rm -r */` 
+    A tuple of the open FMF object, the number of frames, and the frame rate in Hz.\
+    The caller is responsible for closing the FMF object. 
     '''
 
-    assert (names),\
-        "You've inputted an empty list. Please provide a populated list."
-    for name in names:
-        assert(".fmf" in name),\
-            f"The file {name} is not an .fmf video. Please provide an .fmf file."
+    fmf = FMF.FlyMovie(name)
+    n_frames = fmf.get_n_frames()
+    _, first_time_stamp = fmf.get_frame(0)
+    _, last_time_stamp = fmf.get_frame(n_frames - 1)
+    frame_rate = n_frames/(last_time_stamp - first_time_stamp)
 
-    fmfs = []
-    for name in names:
-        
-        # Make a list of fmf objects:
-        fmfs.append(FMF.FlyMovie(name))
-        
-        # Get an fmf from the fmfs
-        fmf = fmfs[names.index(name)]
+    return fmf, n_frames, frame_rate
+
+
+def get_frame_layout (fmf):
+
+    '''
+    Gets the dtype and shape of an .fmf video's frames, as `FlyMovie.get_frame()`\
+    returns them. 
+    
+    Parameters:
+    fmf (FlyMovie): An open FMF object, from `probe()`.
     
-        vid_size = fmf.get_n_frames()
-        time_stamps = fmf.get_all_timestamps()
+    Returns:
+    A tuple of the frames' dtype and shape, or None if the format is unknown.
+    '''
 
-        time_length = time_stamps[-1] - time_stamps[0]
+    height, width = fmf.framesize
 
-        #frame_rate in frames per second
-        frame_rate = vid_size/time_length
+    if fmf.format in ("MONO8", "RAW8") or fmf.format.startswith(("MONO8:", "RAW8:")):
+        return np.uint8, (height, width)
+    elif fmf.format == "YUV422":
+        return np.uint16, (height, width)
+    elif fmf.format == "RGB8":
+        return np.uint8, (height, width * 3)
+    elif fmf.format in ("MONO32f", "RAW32f") or fmf.format.startswith("MONO32f:"):
+        return np.float32, (height, width)
+    elif fmf.format == "RGB32f":
+        return np.float32, (height, width, 3)
+    else:
+        return None
 
-        print(f"{frame_rate} Hz is frame rate and {time_length} s is length of video")
 
+def get_pix_fmt (fmf):
 
-def fmf2tiff (names):
+    '''
+    Gets the FFmpeg pixel format of an .fmf video's raw frames, so that FFmpeg can\
+    read them from a pipe as they're stored on disk. 
     
+    Parameters:
+    fmf (FlyMovie): An open FMF object, from `probe()`.
+    
+    Returns:
+    The name of the FFmpeg pixel format. Raises a ValueError if FFmpeg can't read\
+    the .fmf's format as raw video.
     '''
-    Converts a list of .fmf files to .tiff files so they can be converted to mp4s.\
-     Can batch process multiple .fmf videos into multiple 
+
+    if fmf.format in ("MONO8", "RAW8") or fmf.format.startswith(("MONO8:", "RAW8:")):
+        return "gray"
+    elif fmf.format == "YUV422":
+        # Packed as U, Y, V, Y, i.e. 2 bytes per pixel:
+        return "uyvy422"
+    elif fmf.format == "RGB8":
+        return "rgb24"
+    elif fmf.format in ("MONO32f", "RAW32f") or fmf.format.startswith("MONO32f:"):
+        return "grayf32le"
+    else:
+        raise ValueError(f"FFmpeg can't read .fmf frames in the '{fmf.format}' format.")
+
+
+def mmap_fmf (fmf, n_frames):
+
+    '''
+    Memory-maps the frames of an .fmf video, so that they can be sliced without a\
+    seek, read and allocation per frame. Each chunk of an .fmf is a time stamp\
+    followed by the frame's pixels, so the file maps onto a structured array. 
     
     Parameters:
-    names (list): a list of the .fmf files to be converted
+    fmf (FlyMovie): An open FMF object, from `probe()`.
+    n_frames (int): The number of frames in the .fmf file, from `probe()`.
     
     Returns:
-    A directory of .tiff files, where each directory corresponds to an .fmf object.\
-    Can undo in terminal by navigating to `vid_path` and executing `rm -r */`
+    A read-only array of the frames, shaped (n_frames, *frame_shape), with the same\
+    dtype and frame shape as `get_frame()` returns. Is None if the format is unknown,\
+    in which case frames should be read with `get_frame()`.
+    '''
+
+    layout = get_frame_layout(fmf)
+    if layout is None:
+        return None
+
+    dtype, shape = layout
+    chunk = np.dtype([("timestamp", "d"), ("frame", dtype, shape)])
+    if chunk.itemsize != fmf.bytes_per_chunk:
+        return None
+
+    chunks = np.memmap(fmf.filename, dtype=chunk, mode="r", 
+                       offset=fmf.chunk_start, shape=(n_frames,))
+
+    return chunks["frame"]
+
+
+def progress_kwargs (n_frames):
+
+    '''
+    Gets `tqdm` arguments that refresh the progress bar about 200 times per video\
+    at most, so that the bar doesn't slow down fast per-frame loops.
     
+    Parameters:
+    n_frames (int): The number of frames to be looped over.
+    
+    Returns:
+    A dict of keyword arguments for `tqdm.tqdm()`.
     '''
 
-    assert (names),\
-        "You've inputted an empty list. Please provide a populated list."
-    for name in names:
-        assert(".fmf" in name),\
-            f"The file {name} is not an .fmf video. Please provide an .fmf file."
+    return {"mininterval": 0.5, "miniters": max(1, n_frames//200)}
+
+
+def save_tiff (folder, i, frame):
+
+    '''
+    Saves a frame as a numbered .tiff file. Writes uncompressed and contiguous,\
+    which skips the overhead of a generic image writer.
     
-    fmfs = []
+    Parameters:
+    folder (str): The directory of .tiff files.
+    i (int): The index of the frame in its .fmf video.
+    frame (ndarray): The frame.
     
-    for name in names:
-        
-        # Make a list of fmf objects:
-        fmfs.append(FMF.FlyMovie(name))
-        
-        # Get an fmf from the fmfs:
-        fmf = fmfs[names.index(name)]
-        # For each fmf, convert it to a series of .tiffs and store the series in its respective directory:
-        print("Converting .fmf video to .tiff files ...")
-        i = 0
-        for im in tqdm.tqdm(range(len(fmf.get_all_timestamps()))):
-            skimage.io.imsave(arr=fmf.get_frame(i)[0], 
-                              fname=name.replace('.fmf','') + '/' +
-                                    str(format(i, '08d')) + '.tiff')
-            i += 1
+    Returns:
+    A .tiff file, named by its zero-padded frame index. 
+    '''
+
+    tifffile.imwrite(f"{folder}/{i:08d}.tiff", 
+                     frame, 
+                     contiguous=True, photometric='minisblack')
+
 
+def get_preset (crf):
 
-def tiff2vid (names, output, save_tiffs, crf):
+    '''
+    Picks a libx264/libx265 preset for a constant rate factor. At low crfs, nearly\
+    every residual is kept, so the motion search and lookahead of slower presets\
+    save few bits, and only cost time. 
+    
+    Parameters:
+    crf (int): The constant rate factor for video compression, ranging from 0,\
+     the least compressed, to 51, the most compressed. 
     
+    Returns:
+    The name of the preset. 
+    '''
+
+    if crf <= 6:
+        return "ultrafast"
+    elif crf <= 18:
+        return "veryfast"
+    else:
+        return "medium"
+
+
+def get_encoder_args (encoder, crf, preset=None, threads=2):
+
     '''
-    Converts .tiffs located in a directory into an .mp4 file.\
-    Can batch process multiple directories of .tiffs into multiple respective .mp4 files.
+    Gets the FFmpeg output arguments that select a video encoder and set its quality.\
+    Hardware encoders don't take a constant rate factor, so `crf` is passed as\
+    their closest equivalent.
     
-    Paramters:
-    names (list): A list of the .fmf files to be converted.
+    Parameters:
+    encoder (str): The FFmpeg video encoder. E.g. "libx264" for the CPU, "h264_nvenc"\
+     or "hevc_nvenc" for NVIDIA GPUs, "h264_qsv" for Intel GPUs, or "h264_amf" for AMD GPUs.
+    crf (int): The constant rate factor for video compression, ranging from 0,\
+     the least compressed, to 51, the most compressed. 
+    preset (str or None): The libx264/libx265 preset, which trades encoding speed for\
+     compression. If None, is picked from `crf` by `get_preset()`. Hardware encoders\
+     keep their own presets.
+    threads (int): The number of threads each FFmpeg process encodes with. Keeps\
+     parallel FFmpeg processes from oversubscribing the CPU.
+    
+    Returns:
+    A list of FFmpeg arguments.
+    '''
+
+    if "nvenc" in encoder:
+        quality = ["-preset", "p4", "-rc", "vbr", "-cq", str(crf)]
+    elif "qsv" in encoder:
+        quality = ["-global_quality", str(crf)]
+    elif "amf" in encoder:
+        quality = ["-rc", "cqp", "-qp_i", str(crf), "-qp_p", str(crf)]
+    else:
+        quality = ["-preset", preset or get_preset(crf), "-crf", str(crf)]
+
+    return ["-c:v", encoder, *quality, "-threads", str(threads)]
+
+
+def get_output_args (output, faststart=False):
+
+    '''
+    Gets the FFmpeg arguments that set the output pixel format and, for .mp4s,\
+    the position of the index. 
+    
+    Parameters:
+    output (str): The desired output video type. Accepts either "avi" or "mp4".
+    faststart (bool): If True, moves an .mp4's index (its moov atom) to the front\
+     of the file, so that it can play before it has fully loaded. FFmpeg does\
+     this in an extra pass after encoding. Has no effect on .avis.
+    
+    Returns:
+    A list of FFmpeg arguments.
+    '''
+
+    args = ["-pix_fmt", "yuv420p"]
+    if faststart and output == "mp4":
+        args += ["-movflags", "+faststart"]
+
+    return args
+
+
+def writev_all (fd, buffers):
+
+    '''
+    Writes a batch of buffers to a file descriptor with as few `writev` syscalls as\
+    possible, without first copying them into one `bytes` object. 
+    
+    Parameters:
+    fd (int): The file descriptor, e.g. of FFmpeg's stdin.
+    buffers (list): C-contiguous buffers, e.g. frames sliced from `mmap_fmf()`.
+    
+    Returns:
+    None. Retries after partial writes until every byte is written. 
+    '''
+
+    views = [memoryview(buffer).cast("B") for buffer in buffers]
+    while views:
+        n_written = os.writev(fd, views)
+        # Drop the buffers that were fully written, and trim a partially written one:
+        while views and n_written >= len(views[0]):
+            n_written -= len(views.pop(0))
+        if views:
+            views[0] = views[0][n_written:]
+
+
+def fmf2vid_stream (name, fmf, n_frames, output, crf, frame_rate, encoder="libx264", 
+                    preset=None, threads=2, faststart=False, tiff_dir=None):
+
+    '''
+    Converts an .fmf file straight into an .avi or .mp4 file, by streaming its raw\
+    frames into FFmpeg's stdin, rather than through a directory of .tiff files.\
+    If the .tiffs are to be kept, they're written in the same pass, and never\
+    read back.
+    
+    Parameters:
+    name (str): The .fmf file to be converted.
+    fmf (FlyMovie): The open FMF object of `name`, from `probe()`.
+    n_frames (int): The number of frames in the .fmf file, from `probe()`.
     output (str): The desired output video type. Accepts either "avi" or "mp4".
-    save_tiffs (bool): A flag to delete directories containing the input tiff\
-    files, after conversion
     crf (int): The constant rate factor for video compression, ranging from 0,\
      the least compressed, to 51, the most compressed. 
+    frame_rate (float): The frame rate of the .fmf video, from `probe()`.
+    encoder (str): The FFmpeg video encoder. See `get_encoder_args()`.
+    preset (str or None): The libx264/libx265 preset. See `get_encoder_args()`.
+    threads (int): The number of FFmpeg encoding threads. See `get_encoder_args()`.
+    faststart (bool): Whether to move an .mp4's index to the front. See `get_output_args()`.
+    tiff_dir (str): If given, an existing directory to also save each frame to,\
+     as a .tiff. See `mkdirs4tiffs()`.
     
     Returns:
-    .mp4 files in the same directory as the .fmf files. Can undo in terminal\
-     by navigating to `vid_path` and executing `rm *.!(fmf)` 
+    An .avi or .mp4 file in the same directory as the .fmf file. 
     '''
 
-    assert (0 <= crf <= 51), "crf is not an int between 0 and 51."
-    assert (names),\
-        "You've inputted an empty list. Please provide a populated list."
-    for name in names:
-        assert(".fmf" in name),\
-            f"The file {name} is not an .fmf video. Please provide an .fmf file."
-    assert (output == "avi" or "mp4"), \
-        f"Please specify either 'avi' or 'mp4', and not '{output}' as the output\
-        file type."
+    # Tell FFmpeg the layout of the raw frames, from the .fmf's format. The frame 
+    # size is in pixels, whatever the number of bytes or channels per pixel:
+    pix_fmt = get_pix_fmt(fmf)
+    height, width = fmf.framesize
+    # Floating-point frames span 0 to 1, i.e. the full range, not the video range:
+    range_args = ["-color_range", "pc"] if pix_fmt == "grayf32le" else []
+
+    out_path = name[:-len(".fmf")] + '.' + output
+    args = [FFMPEG, "-y",
+            "-f", "rawvideo", "-pix_fmt", pix_fmt, *range_args, "-s", f"{width}x{height}", 
+            "-r", str(frame_rate), "-i", "-",
+            *get_encoder_args(encoder, crf, preset, threads), 
+            *get_output_args(output, faststart),
+            out_path]
+    # Buffer the pipe well past the default 8 KiB, so that small frames coalesce 
+    # into large writes. Mapped frames bypass the buffer, via `writev_all()`:
+    proc = subprocess.Popen(args, stdin=subprocess.PIPE, bufsize=PIPE_BUFFER_SIZE)
+
+    # Slice frames straight out of the mapped file where possible:
+    frames = mmap_fmf(fmf, n_frames)
+
+    # Write any .tiffs on worker threads, so that the disk writes overlap with the pipe:
+    tiff_saves = []
+    if tiff_dir is not None:
+        tiff_writer = ThreadPoolExecutor(max_workers=TIFF_WRITERS)
+
+    print(f"Streaming {name} to {out_path} ...")
+    try:
+        if frames is not None:
+            # Hand FFmpeg several mapped frames per syscall, with no copies:
+            with tqdm.tqdm(total=n_frames, **progress_kwargs(n_frames)) as pbar:
+                for start in range(0, n_frames, FRAMES_PER_WRITE):
+                    batch = frames[start:start + FRAMES_PER_WRITE]
+                    if tiff_dir is not None:
+                        for i, frame in enumerate(batch, start):
+                            tiff_saves.append(tiff_writer.submit(save_tiff, tiff_dir, i, frame))
+                    writev_all(proc.stdin.fileno(), list(batch))
+                    pbar.update(len(batch))
+        else:
+            for i in tqdm.tqdm(range(n_frames), **progress_kwargs(n_frames)):
+                frame = np.ascontiguousarray(fmf.get_frame(i)[0])
+                if tiff_dir is not None:
+                    tiff_saves.append(tiff_writer.submit(save_tiff, tiff_dir, i, frame))
+                proc.stdin.write(frame)
+    except BrokenPipeError:
+        # FFmpeg quit early, e.g. on a bad encoder; its exit code, below, says why:
+        pass
+    finally:
+        # Closing stdin tells FFmpeg to finalize the file:
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        returncode = proc.wait()
+        if tiff_dir is not None:
+            tiff_writer.shutdown()
+
+    # Raise on a failed encode or mux, rather than leave a truncated video behind silently:
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, args)
+
+    # Raise any errors from the .tiff writes:
+    for tiff_save in tiff_saves:
+        tiff_save.result()
+
+
+def fmf2vid_opencv (name, fmf, n_frames, output, frame_rate):
+
+    '''
+    Converts an .fmf file into an .avi or .mp4 file in-process, with OpenCV's\
+    VideoWriter, rather than with an FFmpeg subprocess. OpenCV gives no control\
+    over the constant rate factor, so use FFmpeg when exact quality matters.
     
-    in_paths = []
-    out_paths = []
+    Parameters:
+    name (str): The .fmf file to be converted.
+    fmf (FlyMovie): The open FMF object of `name`, from `probe()`.
+    n_frames (int): The number of frames in the .fmf file, from `probe()`.
+    output (str): The desired output video type. Accepts either "avi" or "mp4".
+    frame_rate (float): The frame rate of the .fmf video, from `probe()`.
     
-    fmfs = []
+    Returns:
+    An .avi or .mp4 file in the same directory as the .fmf file. 
+    '''
+
+    # OpenCV encodes only 8-bit grayscale or BGR frames:
+    pix_fmt = get_pix_fmt(fmf)
+    if pix_fmt == "grayf32le":
+        raise ValueError(f"OpenCV can't encode '{fmf.format}' frames. Use the FFmpeg engine.")
+    height, width = fmf.framesize
+    is_color = pix_fmt != "gray"
+
+    # MPEG-4 Part 2 caps the time base denominator at 65535, so round the frame rate.
+    # Prefer H.264 for .mp4s, but not every OpenCV build ships an H.264 encoder:
+    out_path = name[:-len(".fmf")] + '.' + output
+    fourccs = ["avc1", "mp4v"] if output == "mp4" else ["XVID"]
+    for fourcc in fourccs:
+        out = cv2.VideoWriter(filename=out_path, 
+                              apiPreference=0, 
+                              fourcc=cv2.VideoWriter_fourcc(*fourcc), 
+                              fps=round(frame_rate, 2), 
+                              frameSize=(width, height), 
+                              isColor=is_color)
+        if out.isOpened():
+            break
+        print(f"OpenCV can't encode with '{fourcc}', trying the next codec ...")
+    else:
+        raise RuntimeError(f"OpenCV could not open a video writer for {out_path}")
+
+    frames = mmap_fmf(fmf, n_frames)
+
+    print(f"Encoding {name} to {out_path} with OpenCV ...")
+    try:
+        for i in tqdm.tqdm(range(n_frames), **progress_kwargs(n_frames)):
+            frame = frames[i] if frames is not None else fmf.get_frame(i)[0]
+            if pix_fmt == "rgb24":
+                frame = cv2.cvtColor(frame.reshape(height, width, 3), cv2.COLOR_RGB2BGR)
+            elif pix_fmt == "uyvy422":
+                frame = cv2.cvtColor(frame.view(np.uint8).reshape(height, width, 2), cv2.COLOR_YUV2BGR_UYVY)
+            out.write(frame)
+    finally:
+        out.release()
+
+
+def convert_one (name, output, crf, save_tiffs, encoder="libx264", 
+                 preset=None, threads=2, engine="ffmpeg", faststart=False):
+
+    '''
+    Converts a single .fmf file into an .avi or .mp4 file. Is a top-level function,\
+    so that files can be converted in parallel worker processes.
     
-    for name in names:
-        
-        # Compute the exact frame rate of each video for FFmpeg conversions:
-        fmfs.append(FMF.FlyMovie(name))
-        fmf = fmfs[names.index(name)]
-        vid_size = fmf.get_n_frames()
-        time_stamps = fmf.get_all_timestamps()
-        time_length = time_stamps[-1] - time_stamps[0]
-        frame_rate = vid_size/time_length
-        
-        # Convert:
-        in_paths.append(name.replace('.fmf','/%08d.tiff'))
+    Parameters:
+    name (str): The .fmf file to be converted.
+    output (str): The desired output video type. Accepts either "avi" or "mp4".
+    crf (int): The constant rate factor for video compression, ranging from 0,\
+     the least compressed, to 51, the most compressed. 
+    save_tiffs (bool): If True, also keeps a directory of the frames as .tiff files.
+    encoder (str): The FFmpeg video encoder. See `get_encoder_args()`.
+    preset (str or None): The libx264/libx265 preset. See `get_encoder_args()`.
+    threads (int): The number of FFmpeg encoding threads. See `get_encoder_args()`.
+    faststart (bool): Whether to move an .mp4's index to the front. See `get_output_args()`.
+    engine (str): Encode with an FFmpeg subprocess, "ffmpeg", or in-process with\
+     OpenCV, "opencv". Ignored if `save_tiffs` is True. 
+    
+    Returns:
+    An .avi or .mp4 file in the same directory as the .fmf file. 
+    '''
+
+    # Open the .fmf and read its time stamps only once:
+    fmf, n_frames, frame_rate = probe(name)
+    print(f"{frame_rate} Hz is frame rate and {n_frames/frame_rate} s is length of {name}")
+
+    try:
+        # Only write .tiffs to disk if they're to be kept, and even then, 
+        # stream the frames to FFmpeg instead of reading the .tiffs back:
+        if save_tiffs:
+            mkdirs4tiffs([name])
+            fmf2vid_stream(name, fmf, n_frames, output, crf, frame_rate, encoder, 
+                           preset, threads, faststart, tiff_dir=name[:-len(".fmf")])
+
+        elif engine == "opencv":
+            fmf2vid_opencv(name, fmf, n_frames, output, frame_rate)
 
-        if output == "avi":
-            out_paths.append(name.replace('.fmf','.avi'))
-        elif output == "mp4":
-            out_paths.append(name.replace('.fmf','.mp4'))
-        
-        ff = FFmpeg(
-            inputs={in_paths[names.index(name)]: '-r '+ 
-                    str(frame_rate) +
-                    ' -f image2'},
-            outputs={out_paths[names.index(name)]: '-c:v libx264 -crf ' + 
-                    str(crf) + 
-                    ' -pix_fmt yuv420p'} 
-        )
-        ff.run()
-
-        # Remove folders containing tiffs, based on flag:
-        if save_tiffs == False:
-            
-            if len(os.listdir(name.replace(".fmf",""))) != 0:
-                shutil.rmtree(name.replace(".fmf",""))
-            else:
-                print("No .tiff files in this directory")
-        
         else:
-            print("Save .tiffs flag is true")
-            continue
+            fmf2vid_stream(name, fmf, n_frames, output, crf, frame_rate, encoder, 
+                           preset, threads, faststart)
+
+    finally:
+        fmf.close()
 
 
 def main():
@@ -230,6 +525,26 @@ def main():
     parser.add_argument("-t","--tiffs", action="store_true", default=False,
         help="If enabled, a directory of uncompressed .tiffs from\
             the .fmf file is retained. Default is false.")
+    parser.add_argument("-e","--encoder", default="libx264",
+        help="The FFmpeg video encoder. E.g. 'h264_nvenc' or 'hevc_nvenc' to encode\
+            on an NVIDIA GPU, 'h264_qsv' on an Intel GPU, or 'h264_amf' on an AMD GPU.\
+            Default is 'libx264', which encodes on the CPU.")
+    parser.add_argument("-p","--preset", default=None,
+        help="The libx264/libx265 preset, from 'ultrafast' to 'veryslow'. Faster\
+            presets encode faster at a larger file size. Ignored by hardware\
+            encoders. Default is 'ultrafast' for a crf up to 6, 'veryfast' for a crf\
+            up to 18, and 'medium' above that.")
+    parser.add_argument("-n","--threads", type=int, default=2,
+        help="The number of threads each FFmpeg process encodes with. Several\
+            videos are encoded at once, so keep this low. Default is 2.")
+    parser.add_argument("-g","--engine", choices=["ffmpeg", "opencv"], default="ffmpeg",
+        help="Encode with an FFmpeg subprocess, or in-process with OpenCV's VideoWriter.\
+            OpenCV skips the subprocess, but ignores the crf and the encoder options.\
+            Ignored if the .tiffs are kept. Default is 'ffmpeg'.")
+    parser.add_argument("--faststart", action="store_true", default=False,
+        help="If enabled, moves each .mp4's index to the front of the file, so that\
+            it can start playing before it has fully loaded, e.g. over a network.\
+            Costs one extra pass over each .mp4. Default is false.")
     args = parser.parse_args()
 
     root = args.root
@@ -237,18 +552,35 @@ def main():
     output_type = args.output_type
     crf = args.crf
     save_tiffs = args.tiffs
+    encoder = args.encoder
+    preset = args.preset
+    threads = args.threads
+    engine = args.engine
+    faststart = args.faststart
         
     # Get the list of .fmf files to be converted:
     names = sorted(glob.glob(join(root, nesting * "*/", "*.fmf")))
 
     assert (names), \
         f"The directory, {root}, is empty. Are you sure you specified a directory?"
+    # Validate the inputs here once, rather than in every function:
+    not_fmfs = [name for name in names if not name.endswith(".fmf")]
+    assert (not not_fmfs), \
+        f"The files {not_fmfs} are not .fmf videos. Please provide .fmf files."
+    assert (output_type in ("avi", "mp4")), \
+        f"Please specify either 'avi' or 'mp4', and not '{output_type}' as the output\
+        file type."
+    assert (0 <= crf <= 51), "crf is not an int between 0 and 51."
 
-    # Convert:
-    mkdirs4tiffs(names)
-    get_framerate_duration(names)
-    fmf2tiff(names)
-    tiff2vid(names, output_type, save_tiffs, crf)
+    # Convert. Each file is an independent job that opens and probes its .fmf
+    # only once, so convert them in parallel, leaving cores for FFmpeg's own
+    # encoding threads:
+    with ProcessPoolExecutor(max_workers=max(1, os.cpu_count()//2)) as executor:
+        list(executor.map(partial(convert_one, output=output_type, crf=crf, 
+                                  save_tiffs=save_tiffs, encoder=encoder, 
+                                  preset=preset, threads=threads, engine=engine, 
+                                  faststart=faststart), 
+                          names))
 
 
 if __name__ == "__main__":
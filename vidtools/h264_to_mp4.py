@@ -1,15 +1,116 @@
 """
 Batch convert .h264 files to .mp4.
-Can output the .mp4 file in monochrome. 
+Can output the .mp4 file in monochrome, on an NVIDIA GPU if there is one. 
 Will not overwrite existing videos. 
 """
 
 import subprocess
-from os.path import splitext, expanduser, basename
+from os import cpu_count
+from os.path import splitext, expanduser, basename, abspath
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 
+from vidtools.common import find_files, iter_gray_frames, FFmpegWriter
+
+
+# Show every this many frames of the monochrome conversion:
+SHOW_EVERY = 30
+# Remux up to this many videos per FFmpeg process:
+REMUX_BATCH_SIZE = 8
+
+
+def remux_h264(vids, output_vids, framerate, root):
+
+    """
+    Losslessly remuxes .h264 videos into .mp4s, by copying their streams with a 
+    single FFmpeg process, which maps each input to its own output. Pays FFmpeg's 
+    startup once per batch, rather than once per video. 
+
+    Parameters:
+    -----------
+    vids (list): Paths to the .h264 videos.
+    output_vids (list): Paths to the output .mp4 videos, in the same order as `vids`.
+    framerate (str): The framerate of the .h264 videos.
+    root (str): The directory to run FFmpeg from. 
+
+    Returns:
+    --------
+    None. Writes the .mp4 videos. If FFmpeg fails, e.g. on a corrupt video, deletes 
+    the batch's partial outputs, then remuxes each video on its own, so that the 
+    others still get remuxed, and raises for the ones that failed. 
+    """
+
+    # A raw .h264 stream has no container timestamps, so have FFmpeg generate any 
+    # missing ones from the framerate. Batches run concurrently, so keep each FFmpeg 
+    # off the shared terminal's stdin, where it would wait on, or eat, keypresses:
+    args = ["ffmpeg", "-nostdin"]
+    for vid in vids:
+        args += ["-framerate", framerate, "-fflags", "+genpts", "-i", vid]
+    for i, output_vid in enumerate(output_vids):
+        args += ["-map", str(i), "-c", "copy", output_vid]
+    equivalent_cmd = " ".join(args)
+
+    print(f"running command {equivalent_cmd} from {root}")
+    returncode = subprocess.run(args, cwd=root).returncode
+
+    if returncode == 0:
+        return
+
+    # A failed output would otherwise be skipped as already converted on the next run:
+    for output_vid in output_vids:
+        Path(output_vid).unlink(missing_ok=True)
+
+    if len(vids) == 1:
+        raise subprocess.CalledProcessError(returncode, args)
+
+    # One bad input fails the whole process, so find which, by retrying each on its own:
+    failed = []
+    for vid, output_vid in zip(vids, output_vids):
+        try:
+            remux_h264([vid], [output_vid], framerate, root)
+        except subprocess.CalledProcessError:
+            failed.append(vid)
+
+    if failed:
+        raise RuntimeError(f"FFmpeg failed to remux {failed}.")
+
+
+def mono_h264_nvenc(vid, output_vid, framerate):
+
+    """
+    Converts an .h264 video to a monochrome .mp4 with a single FFmpeg process, 
+    which decodes on an NVIDIA GPU with NVDEC and encodes with NVENC. Only the 
+    cheap drop of the chroma runs on the CPU. 
+
+    Parameters:
+    -----------
+    vid (str): Path to the .h264 video.
+    output_vid (str): Path to the output .mp4 video.
+    framerate (str): The framerate of the .h264 video.
+
+    Returns:
+    --------
+    True if the conversion succeeded. False if it failed, e.g. because there is 
+    no NVIDIA GPU, or FFmpeg was built without CUDA. A failed conversion leaves 
+    no output video behind. 
+    """
+
+    # NVENC doesn't take single-channel frames, so keep the luma and 
+    # flatten the chroma to grey:
+    args = ["ffmpeg", "-nostdin", "-y", "-hwaccel", "cuda", 
+            "-framerate", framerate, "-fflags", "+genpts", "-i", vid, 
+            "-vf", "format=gray,format=yuv420p", 
+            "-c:v", "h264_nvenc", "-preset", "p1", output_vid]
+
+    try:
+        subprocess.run(args, check=True, capture_output=True)
+        return True
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        Path(output_vid).unlink(missing_ok=True)
+        return False
+
 
 # Formatted for click; config is a dict loaded from yaml:
 def main(config):
@@ -17,12 +118,17 @@ def main(config):
     root = expanduser(config["h264_to_mp4"]["root"])
     framerate = str(config["h264_to_mp4"]["framerate"])
     do_mono = config["h264_to_mp4"]["do_mono"]
+    do_show = config["h264_to_mp4"]["do_show"]
 
-    vids = [str(path.absolute()) for path in Path(root).rglob("*.h264")]
+    vids = list(find_files(abspath(root), ".h264"))
 
     if len(vids) == 0:
         raise ValueError("No '.h264' videos were found.")
 
+    to_remux = []
+    # Try the GPU until it first fails:
+    has_nvenc = True
+
     for vid in vids:
         
         print(f"Processing {vid} ...")
@@ -36,48 +142,71 @@ def main(config):
 
             if not do_mono:
                     
-                # Convert:
-                args = ["ffmpeg", "-framerate", framerate, "-i", vid, "-c", "copy", output_vid]
-                equivalent_cmd = " ".join(args)
-
-                print(f"running command {equivalent_cmd} from {root}")
-                subprocess.run(args, cwd=root)
+                # Convert, later, in batches:
+                to_remux.append((vid, output_vid))
             
+            elif has_nvenc and mono_h264_nvenc(vid, output_vid, framerate):
+
+                print(f"Converted {basename(output_vid)} to monochrome on the GPU.")
+
             else:
 
+                if has_nvenc:
+                    print("Could not convert on an NVIDIA GPU. Falling back to the CPU ...")
+                    has_nvenc = False
+
                 cap = cv2.VideoCapture(vid)
+                frame_size = (int(cap.get(3)), int(cap.get(4)))
+                is_opened = cap.isOpened()
+                cap.release()
+                if not is_opened or 0 in frame_size:
+                    raise ValueError(f"'{vid}' could not be opened, or has no frames.")
 
-                # Define the codec and create VideoWriter object
-                fourcc = cv2.VideoWriter_fourcc(*"mp4v") 
-                out = cv2.VideoWriter(filename=output_vid, 
-                                      apiPreference=0, 
-                                      fourcc=fourcc, 
+                # Encode with FFmpeg's libx264, which, unlike OpenCV's 'mp4v' encoder, 
+                # spreads the encode over all cores:
+                try:
+                    with FFmpegWriter(output_vid, 
                                       fps=int(framerate), 
-                                      frameSize=(int(cap.get(3)), int(cap.get(4))), 
-                                      params=None)
+                                      frame_size=frame_size, 
+                                      is_color=False) as out:
 
-                while cap.isOpened():
+                        # Decode straight to grayscale, and save, as a single channel:
+                        for i, gray in enumerate(iter_gray_frames(vid, frame_size)):
 
-                    ret, frame = cap.read()
+                            out.write(gray)
 
-                    if ret:
+                            # Provide a live stream, sparsely, as each imshow() and waitKey() stalls the loop:
+                            if do_show and i % SHOW_EVERY == 0:
+                                cv2.imshow(f"converting {basename(output_vid)} to monochrome ...", gray)
 
-                        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-                        # In OpenCV, images saved to video file must be three channels:
-                        re_bgr = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
-                        # Save:
-                        out.write(re_bgr)
-                        # Provide live stream:
-                        cv2.imshow(f"converting {basename(output_vid)} to monochrome ...", re_bgr)
+                                if cv2.waitKey(1) & 0xFF == ord("q"):
+                                    break
 
-                        if cv2.waitKey(1) & 0xFF == ord("q"):
-                            break
-                    
-                    else:
-                        break
+                # Don't leave a truncated .mp4 behind:
+                except Exception:
+                    Path(output_vid).unlink(missing_ok=True)
+                    raise
                 
-                cap.release()
-                out.release()
-                cv2.destroyAllWindows()
+                if do_show:
+                    cv2.destroyAllWindows()
+
+    # Each batch is an independent FFmpeg process, so run them concurrently, 
+    # splitting the videos evenly enough that every worker gets a batch. 
+    # Threads suffice, as the work happens in the subprocesses:
+    n_workers = max(1, cpu_count()//2)
+    batch_size = min(REMUX_BATCH_SIZE, max(1, -(-len(to_remux) // n_workers)))
+    batches = [to_remux[i:i + batch_size] for i in range(0, len(to_remux), batch_size)]
+    with ThreadPoolExecutor(max_workers=n_workers) as remuxer:
+        remuxes = [remuxer.submit(remux_h264, *zip(*batch), framerate, root) for batch in batches]
+        # Check every batch, so one failure doesn't hide the others:
+        errors = []
+        for remux in remuxes:
+            try:
+                remux.result()
+            except (subprocess.CalledProcessError, RuntimeError) as e:
+                errors.append(e)
+
+    if errors:
+        raise RuntimeError(f"{len(errors)} of {len(batches)} remux batches failed: {errors}")
 
     print("Conversions complete!")            
\ No newline at end of file
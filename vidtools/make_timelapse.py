@@ -1,12 +1,14 @@
 """Make a grayscale timelapse image from a video."""
 
-from os.path import expanduser, splitext, basename, dirname
+from os.path import expanduser, splitext, basename, dirname, abspath
 from pathlib import Path
 
 import numpy as np
 import cv2
 from tqdm import tqdm, trange
 
+from vidtools.common import find_files
+
 
 def get_timelapse(vid, density, is_dark_on_light=True):
 
@@ -46,16 +48,16 @@ def get_timelapse(vid, density, is_dark_on_light=True):
 def main(config):
     
     root = expanduser(config["make_timelapse"]["root"])
-    vid_ending = '*' + config["make_timelapse"]["vid_ending"]
+    vid_ending = config["make_timelapse"]["vid_ending"]
     density = config["make_timelapse"]["density"]
     is_dark_on_light = config["make_timelapse"]["is_dark_on_light"]
 
     if Path(root).is_dir():
 
-        vids = [str(path.absolute()) for path in Path(root).rglob(vid_ending)]
+        vids = list(find_files(abspath(root), vid_ending))
 
         if len(vids) == 0:
-            raise ValueError(f"\nNo videos ending with {vid_ending} were found.")
+            raise ValueError(f"\nNo videos ending with '*{vid_ending}' were found.")
 
         for vid in vids:
 
@@ -11,7 +11,7 @@ import pickle
 import numpy as np
 import cv2
 
-from .common import ask_yes_no, flatten_list
+from .common import ask_yes_no
 
 
 def get_checkerboard_coords(vid, framerate, m_corners, n_corners, frames=[], do_ask=False):
@@ -29,7 +29,8 @@ def get_checkerboard_coords(vid, framerate, m_corners, n_corners, frames=[], do_
     frames (iterable of ints): Specifies the frames in which to look for
         checkerboards. Accepts an iterable of ints, such as a list of ints, where 
         the ints specify the indices of the frames in the video. If the length of 
-        the iterable is 0, will randomly draw 5 frames from the video. 
+        the iterable is 0, will randomly draw 5 distinct frames from the video, with a 
+        fixed seed. 
         Default is an empty list. 
     m_corners (int): Number of internal corners along the rows of the checkerboard.
         Is interchangeable with `n_corners`. 
@@ -41,8 +42,9 @@ def get_checkerboard_coords(vid, framerate, m_corners, n_corners, frames=[], do_
     
     Returns:
     --------
-    The mean length (fl) of checkerboard edges from the specified frames. 
-    Will return None if no checkerboard edges are found. 
+    A list of the refined corners of the checkerboard in each frame where one was 
+    found, each shaped (m*n, 2). Will return None if no checkerboard is found in 
+    any of the frames. 
     """
     
     # 1. DRAW FRAMES FROM VIDEO:
@@ -53,7 +55,10 @@ def get_checkerboard_coords(vid, framerate, m_corners, n_corners, frames=[], do_
     if len(frames) == 0:
         num_chosen = 5
         frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        samples = np.random.choice(frame_count, num_chosen)
+        # Draw distinct frames, so that no frame is decoded and searched twice, 
+        # and seed the draw, so that reruns give the same result:
+        rng = np.random.default_rng(0)
+        samples = rng.choice(frame_count, size=min(num_chosen, frame_count), replace=False)
     
     # Option 2: Draw specified frames from video:
     else:
@@ -61,8 +66,19 @@ def get_checkerboard_coords(vid, framerate, m_corners, n_corners, frames=[], do_
     
     samples = sorted(samples)
     imgs = []
+    pos = 0
     for f in samples:
-        _, frame = cap.read()
+        # Seek to each sample, rather than decoding every frame up to it. The samples 
+        # are sorted, so the seeks only go forwards:
+        if f != pos:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, f)
+        ret, frame = cap.read()
+        pos = f + 1
+
+        if not ret:
+            print(f"Frame {f} could not be read. Skipping ...")
+            continue
+
         gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
         imgs.append(gray) # save imgs
         
@@ -70,6 +86,8 @@ def get_checkerboard_coords(vid, framerate, m_corners, n_corners, frames=[], do_
             cv2.imshow(f"frame_{f}", gray)
             cv2.waitKey(0) # wait for any key
             cv2.destroyAllWindows()# DO NOT CLOSE VIA THE X ON THE GUI IN JUPYTER!
+
+    cap.release()
     
     # 2. DETECT CHECKERBOARD CORNERS:
     
@@ -93,7 +111,9 @@ def get_checkerboard_coords(vid, framerate, m_corners, n_corners, frames=[], do_
         for img in imgs:
         
             # Find the checkerboard corners:
-            do_ret, corners = cv2.findChessboardCorners(img, (m_corners, n_corners), None)
+            # Reject frames without a checkerboard quickly, as in undistort.find_checkerboard():
+            flags = cv2.CALIB_CB_ADAPTIVE_THRESH | cv2.CALIB_CB_NORMALIZE_IMAGE | cv2.CALIB_CB_FAST_CHECK
+            do_ret, corners = cv2.findChessboardCorners(img, (m_corners, n_corners), flags=flags)
 
             # If found, add object points, image points (after refining them):
             if do_ret:
@@ -101,37 +121,26 @@ def get_checkerboard_coords(vid, framerate, m_corners, n_corners, frames=[], do_
                 obj_points.append(obj_p)
 
                 # This method increases the accuracy of the identified corners:
-                better_corners = cv2.cornerSubPix(gray, corners, (11,11), (-1,-1), criteria)
+                better_corners = cv2.cornerSubPix(img, corners, (11,11), (-1,-1), criteria)
                 img_points.append(better_corners)
-
-                # Draw and display the corners:
-                detected = cv2.drawChessboardCorners(frame, (m_corners, n_corners), better_corners, do_ret)
                 
                 # Convert shape of (m*n, 1, 2) to (m*n, 2):
                 better_corners = np.squeeze(better_corners)
                 all_corners.append(better_corners)
             
             else:
-                print("No checkerboard corners were found.")
-                return None
+                # Skip this frame, but keep the checkerboards found in the others:
+                print("No checkerboard corners were found in a frame. Skipping ...")
+
+        if len(all_corners) == 0:
+            print("No checkerboard corners were found.")
+            return None
         
         return all_corners
             
     else:
         exit("\nPlease re-run the script. Exiting ...")
 
-    cap.release()
-
-
-def get_dist(a, b):
-
-    """
-    Find distance between two cartesian points, a and b.
-    a is length 2 and b is length 2. 
-    """
-
-    return np.sqrt( ((a[0]-b[0])**2) + ((a[1]-b[1])**2) )
-
 
 def get_x_dists_checkerboards(all_corners, m_corners, n_corners):
     
@@ -152,20 +161,15 @@ def get_x_dists_checkerboards(all_corners, m_corners, n_corners):
     
     Returns:
     --------
-    A list of distances, in pixels. 
+    A 1D array of distances, in pixels. 
     """
     
-    all_dists = []
+    # Lay each checkerboard's corners out as n_corners rows of m_corners points, 
+    # then take the distances between neighbours along each row:
+    corners = np.asarray(all_corners).reshape(-1, n_corners, m_corners, 2)
+    diffs = np.diff(corners, axis=2)
 
-    for corners in all_corners:
-        dists = [get_dist(corners[i+1], corners[i]) 
-                 for i,_ in enumerate(corners) 
-                 # Don't go past the indices and 
-                 # don't compute dist bw last and final cols of diff rows:
-                 if (i < len(corners)-1) and ((i+1) % m_corners != 0)]
-        all_dists.append(dists)
-
-    return flatten_list(all_dists)
+    return np.hypot(diffs[..., 0], diffs[..., 1]).ravel()
 
 
 def get_y_dists_checkerboards(all_corners, m_corners, n_corners):
@@ -187,29 +191,15 @@ def get_y_dists_checkerboards(all_corners, m_corners, n_corners):
     
     Returns:
     --------
-    A list of distances, in pixels. 
+    A 1D array of distances, in pixels. 
     """
     
-    all_dists = []
-    for corners in all_corners:
+    # Lay each checkerboard's corners out as n_corners rows of m_corners points, 
+    # then take the distances between neighbours down each column, column by column:
+    corners = np.asarray(all_corners).reshape(-1, n_corners, m_corners, 2)
+    diffs = np.diff(corners, axis=1)
 
-        all_col_dists = []
-        for i in range(m_corners):
-        
-            col_corners = corners[i::m_corners]
-
-            col_dists = [get_dist(col_corners[j+1], col_corners[j]) 
-                        for j,_ in enumerate(col_corners) 
-                        # Don't go past the indices:
-                        if (j < len(col_corners)-1)]
-            
-            all_col_dists.append(col_dists)
-        
-        all_col_dists = flatten_list(all_col_dists)
-
-        all_dists.append(all_col_dists)
-    
-    return flatten_list(all_dists)
+    return np.hypot(diffs[..., 0], diffs[..., 1]).transpose(0, 2, 1).ravel()
 
 
 def get_mean_edge_len_checkerboard(all_corners, m_corners, n_corners):
@@ -235,8 +225,11 @@ def get_mean_edge_len_checkerboard(all_corners, m_corners, n_corners):
     The mean edge length of a square from the checkerboard video. 
     """
 
-    return np.mean(get_x_dists_checkerboards(all_corners, m_corners, n_corners) \
-                 + get_y_dists_checkerboards(all_corners, m_corners, n_corners))
+    x_dists = get_x_dists_checkerboards(all_corners, m_corners, n_corners)
+    y_dists = get_y_dists_checkerboards(all_corners, m_corners, n_corners)
+
+    # Average over both sets of edges, without joining them into a new array:
+    return (x_dists.sum() + y_dists.sum()) / (x_dists.size + y_dists.size)
 
 
 # Formatted for click; config is a dict loaded from yaml:
@@ -269,10 +262,12 @@ def main(config):
     if Path(pkl_file).exists():
         q = "The `pxls_to_real.pkl` file already exists. Overwrite?"
         if ask_yes_no(q, default="no"): 
-            pickle.dump(results, open(pkl_file, "wb"))
+            with open(pkl_file, "wb") as f:
+                pickle.dump(results, f, protocol=pickle.HIGHEST_PROTOCOL)
             print("The unrounded values have been saved to `pxls_to_real.pkl`.")
         else:
             exit("Exiting ...")
     else:
-        pickle.dump(results, open(pkl_file, "wb"))
+        with open(pkl_file, "wb") as f:
+            pickle.dump(results, f, protocol=pickle.HIGHEST_PROTOCOL)
         print("The unrounded values have been saved to `pxls_to_real.pkl`.")
\ No newline at end of file
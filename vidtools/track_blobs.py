@@ -1,4 +1,4 @@
-from os.path import expanduser, splitext, basename
+from os.path import expanduser, splitext, basename, abspath
 from pathlib import Path
 import atexit
 import csv
@@ -8,6 +8,7 @@ import numpy as np
 from tqdm import tqdm, trange
 
 from vidtools.sort import *
+from vidtools.common import find_files
 
 
 def init_blob_detector(min_threshold=1, max_threshold=255, 
@@ -391,7 +392,7 @@ def track_blobs(vid, framerate, max_age, min_hits, iou_thresh, bkgd, blob_params
 def main(config):
 
     root = expanduser(config["track_blobs"]["root"])
-    vid_ending = '*' + config["track_blobs"]["vid_ending"]
+    vid_ending = config["track_blobs"]["vid_ending"]
     framerate = config["track_blobs"]["framerate"]
     do_show = config["track_blobs"]["do_show"]
 
@@ -409,11 +410,11 @@ def main(config):
 
     if Path(root).is_dir():
 
-        vids = sorted([str(path.absolute()) for path in Path(root).rglob(vid_ending) 
-                      if "_blobbed" not in str(path.absolute())])
+        vids = sorted([vid for vid in find_files(abspath(root), vid_ending) 
+                       if "_blobbed" not in vid])
 
         if len(vids) == 0:
-            raise ValueError("\nNo untracked videos ending with '.mp4' were found.")
+            raise ValueError(f"\nNo untracked videos ending with '*{vid_ending}' were found.")
 
         for vid in vids:
             
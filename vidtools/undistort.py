@@ -8,24 +8,42 @@ Does not overwrite files, unless in debug mode (-d).
 
 import subprocess
 import pickle
+import json
+import warnings
 from os.path import splitext, expanduser, basename, dirname
-from os import path, mkdir
+from os import path, mkdir, makedirs, listdir, stat, cpu_count
 from pathlib import Path
 from shutil import rmtree
 from sys import exit
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from functools import partial, lru_cache
 
 import cv2
 import numpy as np
-from tqdm import tqdm, trange
+from tqdm import tqdm
 
-from .common import ask_yes_no
+from .common import ask_yes_no, find_files, iter_frames, start_frame_pipeline, bounded_map, write_img, BoundedThreadPoolExecutor, FFmpegWriter
 
 
-def convert_vid_to_jpgs(vid, framerate, backend="opencv"):
+# Let OpenCV's own parallel loops (cvtColor, remap, cornerSubPix, etc.) use every core, 
+# even if another library turned them off:
+cv2.setUseOptimized(True)
+cv2.setNumThreads(cpu_count())
+if not cv2.useOptimized():
+    warnings.warn("OpenCV's optimized code paths are unavailable, so calibrating and undistorting will be slow.")
+
+# The labelled checkerboard .jpgs saved in debug mode are just for viewing, so encode them quickly:
+DEBUG_JPG_PARAMS = [cv2.IMWRITE_JPEG_QUALITY, 75]
+
+
+def convert_vid_to_jpgs(vid, framerate, backend="opencv", do_show=False):
 
     """
     Converts a .mp4 video into a folder of .jpgs. 
     Saves the .jpgs folder into the same directory as the input .mp4 video.
+    Skips a finished conversion of the same, unmodified, video, and, with the 
+    "opencv" backend, resumes an unfinished one. 
 
     Parameters:
     -----------
@@ -33,6 +51,8 @@ def convert_vid_to_jpgs(vid, framerate, backend="opencv"):
     framerate (int): Framerate with which `vid` was recorded.
     backend (str): Backend with which to convert. Can be either "opencv" or "ffmpeg".
         Default is "opencv". The ffmpeg backend is much faster, but is poor quality.
+    do_show (bool): If True, will show a live feed of the frames being converted, 
+        with the "opencv" backend. Default is False. 
 
     Returns:
     --------
@@ -45,70 +65,152 @@ def convert_vid_to_jpgs(vid, framerate, backend="opencv"):
     vid = expanduser(vid)
     jpgs_dir = path.join(dirname(vid), f"{basename(splitext(vid)[0])}")
 
-    if Path(jpgs_dir).is_dir():
+    # A manifest is saved once all the .jpgs are; it tells a complete folder apart from a partial one:
+    manifest_file = path.join(jpgs_dir, "manifest.json")
+    manifest = {"mtime": stat(vid).st_mtime, "framerate": framerate, "backend": backend}
+
+    if Path(manifest_file).is_file():
+        with open(manifest_file, "r") as f:
+            old_manifest = json.load(f)
+    else:
+        old_manifest = {}
+
+    if {k: old_manifest.get(k) for k in manifest} == manifest:
 
         print(f"{basename(jpgs_dir)} already exists at '{dirname(jpgs_dir)}'. Skipping ...")
 
     else:
         
-        mkdir(jpgs_dir)
+        makedirs(jpgs_dir, exist_ok=True)
         print(f"Converting '{basename(vid)}' to .jpgs ...")
+        do_finish = False
 
         if backend=="opencv": 
 
-            cap = cv2.VideoCapture(vid)
+            # Resume a partial conversion of the same video from its last, possibly half-written, .jpg:
+            start = 0
+            if "mtime" not in old_manifest:
+                done = [int(jpg[6:-4]) for jpg in listdir(jpgs_dir) if jpg.startswith("frame_") and jpg.endswith(".jpg")]
+                start = max(done, default=0)
             
-            i = 0
-            while cap.isOpened():
+            # Encode and save the .jpgs on worker threads, while this thread keeps decoding:
+            with BoundedThreadPoolExecutor(max_workers=cpu_count()) as executor:
 
-                ret, frame = cap.read()
+                saves = deque()
+                for i, frame in iter_frames(vid, start=start):
 
-                if ret == True:
+                    saves.append(executor.submit(write_img, path.join(jpgs_dir, f"frame_{i:08d}.jpg"), frame))
 
-                    cv2.imwrite(path.join(jpgs_dir, f"frame_{i:08d}.jpg"), frame)
-                    cv2.imshow(f"converting {basename(vid)} ...", frame) 
+                    # Raise any failed save, without holding on to every finished one:
+                    while saves and saves[0].done():
+                        saves.popleft().result()
 
-                    i += 1
-
-                    if cv2.waitKey(1) & 0xFF == ord("q"):
-                        break
+                    if do_show:
+                        cv2.imshow(f"converting {basename(vid)} ...", frame) 
+                        if cv2.waitKey(1) & 0xFF == ord("q"):
+                            break
 
+                # Finished only if the video ran out of frames, rather than if it was quit early:
                 else:
-                    break
-            
-            cap.release()
-            cv2.destroyAllWindows()
+                    do_finish = True
+
+            # Raise any failed save that was still pending:
+            for save in saves:
+                save.result()
+
+            if do_show:
+                cv2.destroyAllWindows()
 
         elif backend=="ffmpeg":
 
-            args = ["ffmpeg", "-i", vid, "-vf", f"fps={str(framerate)}", "frame_%08d.jpg"]
+            # Drop, rather than duplicate, frames that don't land on the output framerate:
+            args = ["ffmpeg", "-y", "-i", vid, "-vf", f"fps={str(framerate)}", "-vsync", "vfr", "-start_number", "0", "frame_%08d.jpg"]
             equivalent_cmd = " ".join(args)
 
             print(f"Running command {equivalent_cmd} from {jpgs_dir}")
-            subprocess.run(args, cwd=jpgs_dir)
+            do_finish = subprocess.run(args, cwd=jpgs_dir).returncode == 0
+
+        if do_finish:
+            with open(manifest_file, "w") as f:
+                json.dump(manifest, f)
 
 
-def get_img_shape(img):
+def find_checkerboard(img, m_corners, n_corners, do_legacy=False):
 
     """
-    Get the shape of an image.
+    Finds the internal corners of a checkerboard in an image, to sub-pixel accuracy. 
+    Is a top-level function, so that it can run in worker processes.
 
     Parameters:
     -----------
-    img (str): Path to an image
+    img (array): A BGR or grayscale image. 
+    m_corners (int): Number of internal corners along the rows of the checkerboard
+    n_corners (int): Number of internal corners along the columns of the checkerboard
+    do_legacy (bool): If True, will find corners with cv2.findChessboardCorners(), then 
+        refine them with cv2.cornerSubPix(). Otherwise, will find corners with 
+        cv2.findChessboardCornersSB(), which refines them as part of its detection, 
+        after a quick check with cv2.checkChessboard(). Default is False. 
 
     Returns:
-    ---------
-    A length-3 tuple of height, width, then channels. 
+    --------
+    The corners, or None if no checkerboard was found. 
     """
 
-    img = cv2.imread(img, cv2.IMREAD_UNCHANGED)
-    dims = img.shape
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+
+    if not do_legacy:
+
+        # Quickly reject frames without a board, e.g. dark or blurry frames, 
+        # before the much slower exhaustive detector runs on them:
+        if not cv2.checkChessboard(gray, (m_corners, n_corners)):
+            return None
+
+        flags = cv2.CALIB_CB_NORMALIZE_IMAGE | cv2.CALIB_CB_ACCURACY | cv2.CALIB_CB_EXHAUSTIVE
+        ret, better_corners = cv2.findChessboardCornersSB(gray, (m_corners, n_corners), flags=flags)
+
+        return better_corners if ret else None
 
-    return dims
+    # Find the checkerboard corners; the fast check quickly rejects frames without a board:
+    flags = cv2.CALIB_CB_ADAPTIVE_THRESH | cv2.CALIB_CB_NORMALIZE_IMAGE | cv2.CALIB_CB_FAST_CHECK
+    ret, corners = cv2.findChessboardCorners(gray, (m_corners, n_corners), flags=flags)
 
+    if not ret:
+        return None
 
-def calibrate_checkerboard(board_vid, m_corners, n_corners, framerate=30, do_debug=True):
+    # This method increases the accuracy of the identified corners:
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+    better_corners = cv2.cornerSubPix(gray, corners, (11,11), (-1,-1), criteria)
+
+    return better_corners
+
+
+def find_checkerboard_in_jpg(jpg, m_corners, n_corners, do_legacy=False):
+
+    """
+    Reads a .jpg, then finds the internal corners of a checkerboard in it, 
+    with `find_checkerboard()`. Returns just the corners, which are far smaller 
+    than the image to send back from a worker process.
+
+    Parameters:
+    -----------
+    jpg (str): Path to a .jpg image.
+    m_corners (int): Number of internal corners along the rows of the checkerboard
+    n_corners (int): Number of internal corners along the columns of the checkerboard
+    do_legacy (bool): See `find_checkerboard()`. Default is False. 
+
+    Returns:
+    --------
+    The corners, or None if no checkerboard was found. 
+    """
+
+    # Decode only the luma for detecting:
+    gray = cv2.imread(jpg, cv2.IMREAD_GRAYSCALE)
+
+    return find_checkerboard(gray, m_corners, n_corners, do_legacy)
+
+
+def calibrate_checkerboard(board_vid, m_corners, n_corners, framerate=30, do_debug=True, 
+                           stride=None, max_boards=60, do_legacy=False):
 
     """
     Finds internal corners of checkerboards to generate the camera matrix.
@@ -122,11 +224,19 @@ def calibrate_checkerboard(board_vid, m_corners, n_corners, framerate=30, do_deb
     framerate (int): Framerate with which `board_vid` was recorded
     do_debug (bool): If True, will show a live feed of the labelled checkerboards, and
         will save a directory of the labelled checkerboard .jpgs. Default is True. 
+    stride (int or None): If `board_vid` is an .mp4, look for checkerboards only in every 
+        `stride`th frame. If None, will pick a stride that samples ~200 frames from the 
+        video. Default is None. 
+    max_boards (int): If `board_vid` is an .mp4, and more checkerboards than this are found, 
+        calibrate with just this many, drawn evenly from across the video. A few dozen views 
+        suffice for calibrating. Default is 60. 
+    do_legacy (bool): If True, will detect corners with the older two-step approach of 
+        `find_checkerboard()`. Default is False. 
 
     Returns:
     --------
-    A dictionary of length 6 that consists of ret, cam_mtx, dist, r_vecs, t_vecs 
-    from cv2.calibrateCamera() and the mean reprojection error. Saves this dictionary as
+    A dictionary of length 7 that consists of ret, cam_mtx, dist, r_vecs, t_vecs 
+    from cv2.calibrateCamera(), and the per-board and mean reprojection errors. Saves this dictionary as
     a pickle file called 'cam_calib_results.pkl'. If this file already exists, running
     this function will read the pickle file and return the contained dictionary. 
     In addition, saves at least a video of the labelled checkerboards.
@@ -135,7 +245,10 @@ def calibrate_checkerboard(board_vid, m_corners, n_corners, framerate=30, do_deb
     board_vid = expanduser(board_vid)
     assert(basename(board_vid) != "checkerboards.mp4"), "Rename 'checkerboards.mp4' to something else!"
 
-    if Path(board_vid).is_file():
+    # Stat each path just once:
+    is_board_file = Path(board_vid).is_file()
+
+    if is_board_file:
         assert(splitext(board_vid)[1] == ".mp4"), "`board_vid` must be an '.mp4' file!"
 
     output_vid = path.join(dirname(board_vid), "checkerboards.mp4")
@@ -150,174 +263,212 @@ def calibrate_checkerboard(board_vid, m_corners, n_corners, framerate=30, do_deb
         else:
             exit("Quitting ...")
 
-        if Path(boards_dir).is_dir():
-            rmtree(boards_dir)
-        else:
-            mkdir(boards_dir)
+        rmtree(boards_dir, ignore_errors=True)
+        mkdir(boards_dir)
 
-        if Path(output_vid).is_file():
-            Path(output_vid).unlink()
+        Path(output_vid).unlink(missing_ok=True)
+        Path(pkl_file).unlink(missing_ok=True)
 
-        if Path(pkl_file).is_file():
-            Path(pkl_file).unlink()
+    has_output_vid = Path(output_vid).is_file()
+    has_pkl_file = Path(pkl_file).is_file()
 
-    if Path(output_vid).is_file() and Path(pkl_file).is_file():
+    if has_output_vid and has_pkl_file:
         
         print(f"{basename(output_vid)} already exists at {dirname(output_vid)}")
         print(f"Reading {basename(pkl_file)} from {dirname(pkl_file)} ...")
-        cam_calib_results = pickle.load(open(pkl_file, "rb")) 
+        with open(pkl_file, "rb") as f:
+            cam_calib_results = pickle.load(f)
         msg = f"camera matrix: \n{cam_calib_results['cam_mtx']}\n\ndistortion coefficients: \n{cam_calib_results['dist']}\n\nmean reprojection error: \n{cam_calib_results['mean_reproj_error']}\n"
         print(msg)
 
         return cam_calib_results
 
-    elif not Path(output_vid).is_file() and not Path(pkl_file).is_file():
+    elif not has_output_vid and not has_pkl_file:
 
-        # Define the codec:
-        fourcc = cv2.VideoWriter_fourcc(*"mp4v")  
+        fps = int(framerate)
 
         # Set up corner-finding:
         # -----------------------
-        # Termination criteria:
-        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
-
         # Prepare object points like (0,0,0), (1,0,0), (2,0,0) ....,(6,5,0):
         obj_p = np.zeros((n_corners * m_corners, 3), np.float32)
         obj_p[:,:2] = np.mgrid[0:m_corners, 0:n_corners].T.reshape(-1,2)
 
-        # Arrays to store object points and image points from all the images: 
-        obj_points = [] # 3d point in real world space
-        img_points = [] # 2d points in image plane
+        # The 2d points in image plane from all the images go into a buffer, 
+        # preallocated once the most boards that can be found is known:
+        img_points = None
         # ------------------------
 
         i = 0
 
-        if Path(board_vid).is_file():
+        if is_board_file:
 
             cap = cv2.VideoCapture(board_vid)
-            out = cv2.VideoWriter(filename=output_vid, 
-                                  apiPreference=0, 
-                                  fourcc=fourcc, 
-                                  fps=int(framerate), 
-                                  frameSize=(int(cap.get(3)), int(cap.get(4))),
-                                  params=None)
+            img_size = (int(cap.get(3)), int(cap.get(4)))
 
             frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-            pbar = trange(frame_count)
+
+            # Consecutive frames are near-duplicate views, so only sample every `stride`th frame:
+            if stride is None:
+                stride = max(1, frame_count // 200)
+
+            # The frame count is only an estimate for some containers, so collect the boards 
+            # in a list, rather than a buffer sized by it:
+            img_points = []
+
+            with FFmpegWriter(output_vid, fps, img_size, preset="veryfast") as out:
+
+                # Decode and encode on their own threads:
+                frames, write_q, finish = start_frame_pipeline(cap, out, stride=stride)
+
+                # Detect checkerboards in parallel across processes, 
+                # without getting too far ahead of the decoded frames. 
+                # Workers get grayscale frames, which are a third the size to send: 
+                detect = partial(find_checkerboard, m_corners=m_corners, n_corners=n_corners, do_legacy=do_legacy)
+                to_gray = partial(cv2.cvtColor, code=cv2.COLOR_BGR2GRAY)
+
+                # Save debug .jpgs on worker threads:
+                jpg_writer = BoundedThreadPoolExecutor(max_workers=cpu_count())
+                saves = []
             
-            for f,_ in enumerate(pbar):
-                
-                _, frame = cap.read()
-                gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+                try:
+                    with ProcessPoolExecutor(max_workers=cpu_count(), 
+                                             initializer=cv2.setNumThreads, initargs=(1,)) as executor:
 
-                # Find the checkerboard corners:
-                ret, corners = cv2.findChessboardCorners(gray, (m_corners, n_corners), None)
+                        pbar = tqdm(bounded_map(executor, detect, frames, 2 * cpu_count(), key=to_gray), 
+                                    total=-(-frame_count // stride))
 
-                # If found, add object points, image points (after refining them):
-                if ret == True:
-                    
-                    obj_points.append(obj_p)
+                        for f, (frame, better_corners) in enumerate(pbar):
 
-                    # This method increases the accuracy of the identified corners:
-                    better_corners = cv2.cornerSubPix(gray, corners, (11,11), (-1,-1), criteria)
-                    img_points.append(better_corners)
+                            # If found, add object points, image points:
+                            if better_corners is not None:
+                        
+                                img_points.append(better_corners)
 
-                    # Draw and display the corners:
-                    img = cv2.drawChessboardCorners(frame, (m_corners, n_corners), better_corners, ret)
-                    
-                    # Save to video:
-                    out.write(img)
+                                # Draw and display the corners:
+                                img = cv2.drawChessboardCorners(frame, (m_corners, n_corners), better_corners, True)
+                        
+                                # Save to video:
+                                write_q.put(img)
 
-                    if do_debug:
+                                if do_debug:
 
-                        cv2.imwrite(path.join(boards_dir, f"frame_{i:08d}.jpg"), img)
-                        cv2.imshow("checkerboard detected ...", img) 
-                        if cv2.waitKey(1) & 0xFF == ord("q"):
-                            break
+                                    saves.append(jpg_writer.submit(write_img, path.join(boards_dir, f"frame_{i:08d}.jpg"), img, DEBUG_JPG_PARAMS))
+                                    cv2.imshow("checkerboard detected ...", img) 
+                                    if cv2.waitKey(1) & 0xFF == ord("q"):
+                                        break
+
+                                pbar.set_description(f"Found {i+1} checkerboards in {f*stride+1}/{frame_count} frames") 
+                                i += 1
 
-                    pbar.set_description(f"Found {i+1} checkerboards in {f+1}/{frame_count} frames") 
-                    cv2.waitKey(1) 
-                    i += 1
+                finally:
+                    # Stop the pipeline's threads before releasing the video they read:
+                    try:
+                        finish()
+                    finally:
+                        cap.release()
+                        jpg_writer.shutdown()
 
-            cap.release()
+                # Raise any failed save:
+                for save in saves:
+                    save.result()
+
+            img_points = np.array(img_points, np.float32).reshape(i, n_corners * m_corners, 1, 2)
         
         elif Path(board_vid).is_dir():
 
-            jpgs = [str(path.absolute()) for path in Path(board_vid).rglob("*.jpg")]
+            jpgs = sorted(find_files(path.abspath(board_vid), ".jpg"))
             
             if len(jpgs) == 0:
                 raise ValueError("No '.jpg' images were found.")
 
-            jpg_shape = get_img_shape(jpgs[0]) # from first image
-
-            out = cv2.VideoWriter(filename=output_vid, 
-                                  apiPreference=0, 
-                                  fourcc=fourcc, 
-                                  fps=int(framerate), 
-                                  frameSize=(int(jpg_shape[1]), int(jpg_shape[0])),
-                                  params=None) 
+            img_points = np.empty((len(jpgs), n_corners * m_corners, 1, 2), np.float32)
 
-            pbar = tqdm(jpgs)
-            
-            for f, jpg in enumerate(pbar):
+            # Only the dims of the first image are needed, so decode just its luma:
+            jpg_h, jpg_w = cv2.imread(jpgs[0], cv2.IMREAD_GRAYSCALE).shape
+            img_size = (jpg_w, jpg_h)
 
-                img = cv2.imread(jpg)
-                gray = cv2.cvtColor(img,cv2.COLOR_BGR2GRAY)
+            with FFmpegWriter(output_vid, fps, img_size, preset="veryfast") as out:
 
-                # Find the checkerboard corners:
-                ret, corners = cv2.findChessboardCorners(gray, (m_corners, n_corners),None)
+                # Each .jpg is independent, so detect checkerboards in parallel across processes:
+                detect = partial(find_checkerboard_in_jpg, m_corners=m_corners, n_corners=n_corners, do_legacy=do_legacy)
 
-                # If found, add object points, image points (after refining them):
-                if ret == True:
-                    
-                    obj_points.append(obj_p)
+                # Save debug .jpgs on worker threads:
+                jpg_writer = BoundedThreadPoolExecutor(max_workers=cpu_count())
+                saves = []
 
-                    # This method increases the accuracy of the identified corners:
-                    better_corners = cv2.cornerSubPix(gray, corners, (11,11), (-1,-1), criteria)
-                    img_points.append(better_corners)
+                try:
+                    with ProcessPoolExecutor(max_workers=cpu_count(), 
+                                             initializer=cv2.setNumThreads, initargs=(1,)) as executor:
 
-                    # Draw and display the corners:
-                    img = cv2.drawChessboardCorners(img, (m_corners, n_corners), better_corners, ret)
-                    
-                    # Save to video:
-                    out.write(img)
+                        # Don't get too far ahead of the results that have been consumed:
+                        pbar = tqdm(bounded_map(executor, detect, jpgs, 2 * cpu_count()), total=len(jpgs))
+                
+                        for f, (jpg, better_corners) in enumerate(pbar):
+
+                            # If found, add object points, image points:
+                            if better_corners is not None:
+                        
+                                img_points[i] = better_corners
+
+                                # Decode in colour only for drawing found boards, then draw and display the corners:
+                                img = cv2.drawChessboardCorners(cv2.imread(jpg), (m_corners, n_corners), better_corners, True)
+                        
+                                # Save to video, in the same order as the .jpgs:
+                                out.write(img)
+
+                                if do_debug:
+
+                                    saves.append(jpg_writer.submit(write_img, path.join(boards_dir, basename(jpg)), img, DEBUG_JPG_PARAMS))
+                                    cv2.imshow("checkerboard detected ...", img) 
+                                    if cv2.waitKey(1) & 0xFF == ord("q"):
+                                        break
+                        
+                                pbar.set_description(f"Found {i+1} checkerboards in {f+1}/{len(jpgs)} frames") 
+                                i += 1
+        
 
-                    if do_debug:
+                finally:
+                    jpg_writer.shutdown()
 
-                        cv2.imwrite(path.join(boards_dir, basename(jpg)), img)
-                        cv2.imshow("checkerboard detected ...", img) 
-                        if cv2.waitKey(1) & 0xFF == ord("q"):
-                            break
-                    
-                    pbar.set_description(f"Found {i+1} checkerboards in {f+1}/{len(jpgs)} frames") 
-                    cv2.waitKey(1) 
-                    i += 1
+                # Raise any failed save:
+                for save in saves:
+                    save.result()
         
-        out.release
-        cv2.destroyAllWindows()
+        if do_debug:
+            cv2.destroyAllWindows()
+
+        # Keep just the filled part of the buffer; every board has the same 3d points in real world space:
+        img_points = img_points[:i]
+
+        # Calibrate with boards from across the whole video, rather than just its start, 
+        # so that the poses aren't biased towards whichever ones open the video:
+        if is_board_file and i > max_boards:
+            img_points = img_points[np.linspace(0, i - 1, max_boards).round().astype(int)]
+            i = max_boards
+
+        obj_points = [obj_p] * i
 
         # Calibrate: 
         print("Computing camera matrix from calibration data. If many checkerboards were found, will take a long while ...")
-        ret, cam_mtx, dist, r_vecs, t_vecs = cv2.calibrateCamera(obj_points, img_points, 
-                                                                 gray.shape[::-1], 
+        ret, cam_mtx, dist, r_vecs, t_vecs = cv2.calibrateCamera(obj_points, list(img_points), 
+                                                                 img_size, 
                                                                  None, None)
 
-        # Get re-projection error: 
-        total_reproj_error = 0
-        for obj_point, img_point, r_vec, t_vec in zip(obj_points, img_points, r_vecs, t_vecs):
-
-            img_points_2, _ = cv2.projectPoints(obj_point, r_vec, t_vec, cam_mtx, dist)
-            error = cv2.norm(img_point, img_points_2, cv2.NORM_L2) / len(img_points_2)
-            total_reproj_error += np.abs(error)
+        # Get re-projection error, per board, from all the boards' residuals at once: 
+        img_points_2 = np.stack([cv2.projectPoints(obj_p, r_vec, t_vec, cam_mtx, dist)[0] 
+                                 for r_vec, t_vec in zip(r_vecs, t_vecs)])
+        diffs = (img_points - img_points_2).reshape(i, -1)
+        reproj_errors = np.sqrt(np.einsum("ij,ij->i", diffs, diffs)) / (n_corners * m_corners)
 
-        mean_reproj_error = total_reproj_error / len(obj_points)
+        mean_reproj_error = float(reproj_errors.mean())
 
         # Output:
         msg = f"\ncamera matrix: \n{cam_mtx}\n\ndistortion coefficients: \n{dist}\n\nmean reprojection error: \n{mean_reproj_error}\n"
         print(msg)
 
-        cam_calib_results = {"ret": ret, "cam_mtx": cam_mtx, "dist": dist, "r_vecs": r_vecs, "t_vecs": t_vecs, "mean_reproj_error": mean_reproj_error}
-        pickle.dump(cam_calib_results, open(pkl_file, "wb"))
+        cam_calib_results = {"ret": ret, "cam_mtx": cam_mtx, "dist": dist, "r_vecs": r_vecs, "t_vecs": t_vecs, "reproj_errors": reproj_errors, "mean_reproj_error": mean_reproj_error}
+        with open(pkl_file, "wb") as f:
+            pickle.dump(cam_calib_results, f, protocol=pickle.HIGHEST_PROTOCOL)
 
         return cam_calib_results
 
@@ -325,44 +476,50 @@ def calibrate_checkerboard(board_vid, m_corners, n_corners, framerate=30, do_deb
         exit(f"Only one of {basename(output_vid)} or {basename(pkl_file)} exists at {dirname(board_vid)}. \nPlease delete whichever one exists and re-run.") 
 
 
-def get_undistorted_cropped_dims(vid, cam_mtx, dist):
+def get_undistort_maps(cam_mtx, dist, frame_size, map_type=cv2.CV_16SC2):
 
     """
-    Gets the width and height of the undistorted video, after dead pixels are cropped out.
+    Tailors the camera matrix to a frame size, and builds the lookup maps that 
+    undistort frames of that size with cv2.remap(). The results are memoized, so 
+    that a batch of videos with the same dims and calibration builds them just once.
 
     Parameters:
     -----------
-    vid (str): Path to input video to be distorted
     cam_mtx (array): Camera matrix (3x3), as outputted by OpenCV's calibrateCamera() function.
     dist (array): Input/output vector of distortion coefficients, as outputted by OpenCV's 
         calibrationCamera() function.
+    frame_size (tuple): The width then height of the frames. 
+    map_type (int): The type of the maps. Fixed-point cv2.CV_16SC2 maps are faster to remap 
+        with on the CPU, but CUDA remapping takes floating-point cv2.CV_32FC1 maps. 
+        Default is cv2.CV_16SC2. 
 
     Returns:
     --------
-    The width then height of the undistorted video, after dead pixels are cropped out.
+    The ROI of the undistorted frame without dead pixels, then the two maps. 
     """
 
-    vid = expanduser(vid) 
-    assert(splitext(vid)[1] == ".mp4"), "`vid` must be an '.mp4' file!"
-    
-    cap = cv2.VideoCapture(vid)
+    # NumPy arrays aren't hashable, so key the cache by their values:
+    return get_cached_undistort_maps(tuple(np.ravel(cam_mtx)), tuple(np.ravel(dist)), 
+                                     tuple(frame_size), map_type)
 
-    # Get the 0th frame:
-    cap.set(cv2.CAP_PROP_POS_FRAMES, 0) 
-    _, frame = cap.read()
 
-    h, w = frame.shape[:2]
+@lru_cache(maxsize=8)
+def get_cached_undistort_maps(cam_mtx, dist, frame_size, map_type):
 
-    # Tailor the camera matrix: 
-    _, roi = cv2.getOptimalNewCameraMatrix(cam_mtx, dist, (w,h), 1, (w,h))
-    
-    # Get dimensions of an undistorted frame (all frames have same dims):
-    _,_, width, height = roi
+    """
+    The memoized body of `get_undistort_maps()`, which takes `cam_mtx` and `dist` as flat tuples.
+    """
+
+    cam_mtx = np.array(cam_mtx).reshape(3,3)
+    dist = np.array(dist)
 
-    return width, height
+    new_cam_mtx, roi = cv2.getOptimalNewCameraMatrix(cam_mtx, dist, frame_size, 1, frame_size)
+    map1, map2 = cv2.initUndistortRectifyMap(cam_mtx, dist, None, new_cam_mtx, frame_size, map_type)
 
+    return roi, map1, map2
 
-def undistort(vid, cam_mtx, dist, framerate, do_crop=True):
+
+def undistort(vid, cam_mtx, dist, framerate, do_crop=True, codec="libx264"):
 
     """
     Undistorts a video, given a camera matrix. 
@@ -376,6 +533,8 @@ def undistort(vid, cam_mtx, dist, framerate, do_crop=True):
     framerate (int): Framerate with which `vid` was recorded
     do_crop (bool): If True, will crop the dead pixels out of the undistorted video output. 
         Default is True.
+    codec (str): The FFmpeg encoder for the undistorted video, e.g. "libx264", or 
+        "h264_nvenc" to encode on an NVIDIA GPU. Default is "libx264".
 
     Returns:
     --------
@@ -394,47 +553,63 @@ def undistort(vid, cam_mtx, dist, framerate, do_crop=True):
     else:
 
         cap = cv2.VideoCapture(vid)
+        w, h = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+        # Remap on the GPU, if OpenCV was built with CUDA and a device is available:
+        do_cuda = cv2.cuda.getCudaEnabledDeviceCount() > 0
+
+        # All frames share the same dims, so tailor the camera matrix and build 
+        # the undistortion lookup maps just once (and once per batch of same-sized videos):
+        if do_cuda:
+            # CUDA remapping takes floating-point maps, which are uploaded just once:
+            roi, map1, map2 = get_undistort_maps(cam_mtx, dist, (w,h), cv2.CV_32FC1)
+            gpu_map1, gpu_map2 = cv2.cuda_GpuMat(map1), cv2.cuda_GpuMat(map2)
+            gpu_frame = cv2.cuda_GpuMat()
+            stream = cv2.cuda_Stream()
+        else:
+            # Fixed-point maps are faster to remap with than floating-point maps:
+            roi, map1, map2 = get_undistort_maps(cam_mtx, dist, (w,h), cv2.CV_16SC2)
 
         if do_crop:
-            width, height = get_undistorted_cropped_dims(vid, cam_mtx, dist)
+            # The ROI holds the dims of an undistorted frame, after dead pixels are cropped out:
+            x, y, width, height = roi
         else:
-            width, height = int(cap.get(3)), int(cap.get(4))
-
-        # Define the codec and create VideoWriter object
-        fourcc = cv2.VideoWriter_fourcc(*"mp4v") 
-        out = cv2.VideoWriter(filename=output_vid, 
-                              apiPreference=0, 
-                              fourcc=fourcc, 
-                              fps=int(framerate), 
-                              frameSize=(width, height),
-                              params=None) 
+            width, height = w, h
 
         frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        pbar = trange(frame_count)
-    
-        for f,_ in enumerate(pbar):
-
-            _, frame = cap.read()
-            h, w = frame.shape[:2]
 
-            # Tailor the camera matrix: 
-            new_cam_mtx, roi = cv2.getOptimalNewCameraMatrix(cam_mtx, dist, (w,h), 1, (w,h))
-            
-            # Undistort using the original and new cam matrices: 
-            undistorted = cv2.undistort(frame, cam_mtx, dist, None, new_cam_mtx)
-
-            if do_crop:
-
-                x,y,w,h = roi
-                undistorted = undistorted[y:y+h, x:x+w]
+        # Encode with H.264 via FFmpeg:
+        with FFmpegWriter(output_vid, int(framerate), (width, height), codec=codec) as out:
 
-            # Save:
-            out.write(undistorted) 
-            pbar.set_description(f"Undistorting {f+1}/{frame_count} frames from {basename(vid)}")
+            # Decode and encode on their own threads:
+            frames, write_q, finish = start_frame_pipeline(cap, out)
+            pbar = tqdm(frames, total=frame_count)
+    
+            try:
+                for f, frame in enumerate(pbar):
+                
+                    # Undistort with the precomputed maps: 
+                    if do_cuda:
+                        gpu_frame.upload(frame, stream)
+                        gpu_undistorted = cv2.cuda.remap(gpu_frame, gpu_map1, gpu_map2, cv2.INTER_LINEAR, stream=stream)
+                        undistorted = gpu_undistorted.download(stream)
+                        stream.waitForCompletion()
+                    else:
+                        undistorted = cv2.remap(frame, map1, map2, cv2.INTER_LINEAR)
+
+                    if do_crop:
+                        undistorted = undistorted[y:y+height, x:x+width]
+
+                    # Save:
+                    write_q.put(undistorted) 
+                    pbar.set_description(f"Undistorting {f+1}/{frame_count} frames from {basename(vid)}")
         
-        cap.release()
-        out.release()
-        cv2.destroyAllWindows()
+            finally:
+                # Stop the pipeline's threads before releasing the video they read:
+                try:
+                    finish()
+                finally:
+                    cap.release()
 
 
 # Formatted for click; config is a dict loaded from yaml:
@@ -458,7 +633,7 @@ def main(config):
     
     elif Path(target).is_dir():
 
-        vids = [str(path.absolute()) for path in Path(target).rglob("*.mp4")]
+        vids = sorted(find_files(path.abspath(target), ".mp4"))
         vids = [vid for vid in vids if "checkerboards" not in vid and "undistorted" not in vid]
 
         if len(vids) == 0:
@@ -1,11 +1,13 @@
-from os.path import expanduser, join, splitext, basename
-from os import mkdir
+from os.path import expanduser, join, splitext, basename, abspath
+from os import mkdir, cpu_count
 from shutil import rmtree
 from pathlib import Path
 
 import numpy as np
 import cv2
 
+from vidtools.common import find_files, write_img, BoundedThreadPoolExecutor
+
 
 def vid_to_imgs(vid, frames=[], ext="png", do_ask=False, do_overwrite=False):
 
@@ -110,23 +112,35 @@ def vid_to_imgs(vid, frames=[], ext="png", do_ask=False, do_overwrite=False):
 
         print("No frames were explicitly saved. Saving frames specified in `config.yaml`")
 
-        for f in original_samples:
+        # Encode and save each image on a worker thread, while this thread decodes the next frame:
+        with BoundedThreadPoolExecutor(max_workers=cpu_count()) as executor:
+
+            saves = []
+            for f in original_samples:
 
-            cap.set(cv2.CAP_PROP_POS_FRAMES, f)
-            _, img = cap.read()
-            cv2.imwrite(join(imgs_dir, f"{basename(imgs_dir)}_frame_{f:08d}.{ext}"), img)
+                cap.set(cv2.CAP_PROP_POS_FRAMES, f)
+                ret, img = cap.read()
+                if not ret:
+                    raise ValueError(f"Frame {f} of '{vid}' could not be read.")
+                saves.append(executor.submit(write_img, join(imgs_dir, f"{basename(imgs_dir)}_frame_{f:08d}.{ext}"), img))
     
     # Otherwise, save the images marked with 's' key to file: 
     else:
-        for f, img in zip(good_samples["idx"], good_samples["img"]):
-            cv2.imwrite(join(imgs_dir, f"{basename(imgs_dir)}_frame_{f:08d}.{ext}"), img)
+        with BoundedThreadPoolExecutor(max_workers=cpu_count()) as executor:
+
+            saves = [executor.submit(write_img, join(imgs_dir, f"{basename(imgs_dir)}_frame_{f:08d}.{ext}"), img) 
+                     for f, img in zip(good_samples["idx"], good_samples["img"])]
+
+    # Raise any failed save:
+    for save in saves:
+        save.result()
 
 
 # Formatted for click; config is a dict loaded from yaml:
 def main(config):
 
     root = expanduser(config["vid_to_imgs"]["root"])
-    vid_ending = '*' + config["vid_to_imgs"]["vid_ending"]
+    vid_ending = config["vid_to_imgs"]["vid_ending"]
     ext = config["vid_to_imgs"]["ext"]
     frames = config["vid_to_imgs"]["frames"]
     do_ask = config["vid_to_imgs"]["do_ask"]
@@ -134,10 +148,10 @@ def main(config):
 
     if Path(root).is_dir():
 
-        vids = [str(path.absolute()) for path in Path(root).rglob(vid_ending)]
+        vids = list(find_files(abspath(root), vid_ending))
 
         if len(vids) == 0:
-            raise ValueError("No videos ending with '.mp4' were found.")
+            raise ValueError(f"No videos ending with '*{vid_ending}' were found.")
 
         for vid in vids:
             print(f"Processing {vid} ...")